@@ -2,11 +2,12 @@ from sqlalchemy import (
     Column, ForeignKey, Integer, String, Text
 )
 
-from gam.database import Base, SoftDelete
+from gam.database import Base, Searchable, SoftDelete, Versioned
 from projects.models import Project
 
-class Epic(Base, SoftDelete):
+class Epic(Base, Searchable, SoftDelete, Versioned):
     __tablename__ = 'agile_epic'
+    __searchable__ = ('name', )
 
     id = Column(Integer, primary_key=True)
     project_id = Column(ForeignKey(Project.id), nullable=False)
@@ -14,8 +15,9 @@ class Epic(Base, SoftDelete):
     description = Column(Text, nullable=True)
     order = Column(Integer, server_default='0')
 
-class UserStory(Base, SoftDelete):
+class UserStory(Base, Searchable, SoftDelete, Versioned):
     __tablename__ = 'agile_user_story'
+    __searchable__ = ('name', )
 
     id = Column(Integer, primary_key=True)
     project_id = Column(ForeignKey(Project.id), nullable=False)
@@ -24,8 +26,9 @@ class UserStory(Base, SoftDelete):
     description = Column(Text, nullable=True)
     order = Column(Integer, server_default='0')
 
-class Task(Base, SoftDelete):
+class Task(Base, Searchable, SoftDelete, Versioned):
     __tablename__ = 'agile_task'
+    __searchable__ = ('name', )
 
     id = Column(Integer, primary_key=True)
     project_id = Column(ForeignKey(Project.id), nullable=False)
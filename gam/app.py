@@ -19,14 +19,27 @@ from users.resources import (
     UsersResource,
     UserSettingResource,
 )
-from .middleware import auth_middleware
-from .resources import ModelResource
+from .media import JSONHandler, MessagePackHandler
+from .middleware import (
+    auth_middleware, compression_middleware, content_negotiation_middleware, db_session_middleware,
+    query_log_middleware,
+)
+from .resources import ModelResource, PoolStatusResource
 from .settings import DEBUG, I18N_ASSETS_PATH
 
 def create_app():
     cors = CORS(allow_all_origins=True, allow_all_headers=True, allow_all_methods=True)
     # cors = CORS(allow_all_origins=True, allow_origins_list=ALLOWED_ORIGINS, allow_all_headers=True, allow_all_methods=True)
-    app = falcon.API(middleware=[cors.middleware, auth_middleware])
+    app = falcon.API(middleware=[
+        compression_middleware, cors.middleware, content_negotiation_middleware, query_log_middleware,
+        db_session_middleware, auth_middleware,
+    ])
+    handlers = falcon.media.Handlers({
+        falcon.MEDIA_JSON: JSONHandler(),
+        falcon.MEDIA_MSGPACK: MessagePackHandler(),
+    })
+    app.req_options.media_handlers = handlers
+    app.resp_options.media_handlers = handlers
     
     app.add_route('/auth/login', LoginResource())
     app.add_route('/auth/logout', LogoutResource())
@@ -42,10 +55,13 @@ def create_app():
     ModelResource.register_endpoints('/user_stories', app, UserStoryResource())
 
     sync_resource = SyncResource()
+    app.add_route('/sync/change', sync_resource, suffix='change')
     app.add_route('/sync/changes', sync_resource, suffix='changes')
     app.add_route('/sync/doc/{obj_id}', sync_resource, suffix='doc')
     app.add_route('/sync/docs', sync_resource, suffix='docs')
 
+    app.add_route('/status/pool', PoolStatusResource())
+
     if DEBUG:
         app.add_static_route('/assets/i18n', I18N_ASSETS_PATH)
 
@@ -0,0 +1,157 @@
+""" ASGI entry point, next to gam.app.create_app.
+Falcon 2 and SQLAlchemy 1.3 are synchronous, so resources keep running
+as WSGI on a bounded thread pool, while receiving request bodies and
+sending responses is done by the event loop: slow or idle clients don't
+hold a worker thread while they upload or download.
+"""
+import asyncio
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from .app import create_app
+from .settings import ASGI_THREAD_POOL_SIZE, MAX_REQUEST_BODY_SIZE
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class WSGIHandler:
+    def __init__(self, wsgi_app, executor, max_body_size):
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.__lifespan(receive, send)
+            return
+        if scope['type'] == 'websocket':
+            await self.__reject_websocket(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        try:
+            body = await self.__read_body(receive)
+        except ClientDisconnected:
+            # the body is incomplete, the request must not be handled
+            return
+        if body is None:
+            await send({
+                'type': 'http.response.start',
+                'status': 413,
+                'headers': [(b'content-length', b'0')],
+            })
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        loop = asyncio.get_event_loop()
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and 'status' in response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = status
+            response['headers'] = headers
+
+        environ = self.__get_environ(scope, body)
+        iterable = await loop.run_in_executor(self.executor, self.wsgi_app, environ, start_response)
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': int(response['status'].split(' ', 1)[0]),
+                'headers': [
+                    (name.lower().encode('latin-1'), value.encode('latin-1'), )
+                    for name, value in response['headers']
+                ],
+            })
+            if isinstance(iterable, (list, tuple, )):
+                for chunk in iterable:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            else:
+                # streamed responses are produced on the pool, one chunk at a time
+                iterator = iter(iterable)
+                while True:
+                    chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+                    if chunk is None:
+                        break
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                await loop.run_in_executor(self.executor, close)
+
+    async def __lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def __reject_websocket(self, receive, send):
+        message = await receive()
+        if message['type'] == 'websocket.connect':
+            await send({'type': 'websocket.close', 'code': 1003})
+
+    async def __read_body(self, receive):
+        body = BytesIO()
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise ClientDisconnected()
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.max_body_size:
+                return None
+            body.write(chunk)
+            more_body = message.get('more_body', False)
+        body.seek(0)
+        return body
+
+    def __get_environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80, )
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+            'wsgi.version': (1, 0, ),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in scope['headers']:
+            name = name.decode('latin-1')
+            value = value.decode('latin-1')
+            if name == 'content-type':
+                key = 'CONTENT_TYPE'
+            elif name == 'content-length':
+                key = 'CONTENT_LENGTH'
+            else:
+                key = 'HTTP_{}'.format(name.upper().replace('-', '_'))
+            if key in environ:
+                value = '{},{}'.format(environ[key], value)
+            environ[key] = value
+        return environ
+
+
+def create_asgi_app():
+    executor = ThreadPoolExecutor(max_workers=ASGI_THREAD_POOL_SIZE)
+    return WSGIHandler(create_app(), executor, MAX_REQUEST_BODY_SIZE)
@@ -0,0 +1,105 @@
+""" In-process caches.
+Entries are dropped when their TTL expires and, for the response cache,
+as soon as a change of their table shows up in sync_change.
+"""
+import threading
+import time
+
+from collections import OrderedDict
+
+from sync.utils import get_sync_model
+from sync.watcher import change_watcher
+from .settings import RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread safe LRU mapping whose entries expire after `ttl` seconds."""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.__entries[key]
+                return default
+            self.__entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.__lock:
+            self.__entries[key] = (time.monotonic() + self.ttl, value, )
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+
+class ResponseCache:
+    """Response bodies tagged by table. Every table has a generation,
+    bumped whenever the table changes: entries filled under an older
+    generation are never served.
+    """
+    def __init__(self, enabled, maxsize, ttl, watcher):
+        self.enabled = enabled
+        self.watcher = watcher
+        self.__entries = TTLCache(maxsize, ttl)
+        self.__generations = {}
+        self.__epoch = 0
+        if enabled:
+            watcher.subscribe(self.__on_change)
+
+    def __on_change(self, table_name, _object_id):
+        if table_name is None:
+            self.invalidate_all()
+        else:
+            self.invalidate(table_name)
+
+    def __get_generation(self, table_name):
+        return (self.__epoch, self.__generations.get(table_name, 0), )
+
+    def is_enabled(self, table_name):
+        # only tables tracked by sync_change get invalidated by other processes
+        return self.enabled and get_sync_model(table_name)[0] is not None
+
+    def lookup(self, table_name, key):
+        """Returns the cached body, or None, and the token to store a fresh body with."""
+        if key is None or not self.is_enabled(table_name):
+            return None, None
+        self.watcher.poll()
+        generation = self.__get_generation(table_name)
+        entry = self.__entries.get((table_name, key, ))
+        if entry is not None and entry[0] == generation:
+            return entry[1], None
+        return None, (table_name, key, generation, )
+
+    def store(self, token, body):
+        if token is None:
+            return
+        table_name, key, generation = token
+        self.__entries.set((table_name, key, ), (generation, body, ))
+
+    def invalidate(self, table_name):
+        if self.enabled:
+            self.__generations[table_name] = self.__generations.get(table_name, 0) + 1
+
+    def invalidate_all(self):
+        self.__epoch += 1
+        self.__entries.clear()
+
+response_cache = ResponseCache(RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, change_watcher)
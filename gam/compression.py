@@ -0,0 +1,109 @@
+""" Response compression.
+gzip is always available, brotli and zstd only when their library
+is installed. The encoding is negotiated from the Accept-Encoding header;
+on equal quality values the encodings are preferred in ENCODINGS order.
+"""
+import zlib
+
+from .settings import COMPRESSION_BROTLI_QUALITY, COMPRESSION_GZIP_LEVEL, COMPRESSION_ZSTD_LEVEL
+from .utils import ClosingIterator
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class GzipCompressor:
+    def __init__(self):
+        self.__compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.__compressor.compress(data)
+
+    def flush(self):
+        return self.__compressor.flush()
+
+class BrotliCompressor:
+    def __init__(self):
+        self.__compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self.__compressor.process(data)
+
+    def flush(self):
+        return self.__compressor.finish()
+
+class ZstdCompressor:
+    def __init__(self):
+        self.__compressor = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compressobj()
+
+    def compress(self, data):
+        return self.__compressor.compress(data)
+
+    def flush(self):
+        return self.__compressor.flush()
+
+ENCODINGS = {}
+if brotli is not None:
+    ENCODINGS['br'] = BrotliCompressor
+if zstandard is not None:
+    ENCODINGS['zstd'] = ZstdCompressor
+ENCODINGS['gzip'] = GzipCompressor
+
+def __parse_accept_encoding(header):
+    accepted = {}
+    for entry in header.split(','):
+        coding, _, params = entry.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+def negotiate_encoding(header):
+    """Returns the best of ENCODINGS accepted by the header, None if none is."""
+    if not header:
+        return None
+    accepted = __parse_accept_encoding(header)
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def compress(encoding, data):
+    compressor = ENCODINGS[encoding]()
+    return compressor.compress(data) + compressor.flush()
+
+def __compress_chunks(compressor, chunks):
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def compress_stream(encoding, stream, chunk_size=64 * 1024):
+    """Compresses an iterable or file-like stream as it is read,
+    closing it with the returned stream, whether read or not.
+    """
+    compressor = ENCODINGS[encoding]()
+    if hasattr(stream, 'read'):
+        chunks = iter(lambda: stream.read(chunk_size), b'')
+    else:
+        chunks = stream
+    return ClosingIterator(__compress_chunks(compressor, chunks), getattr(stream, 'close', None))
@@ -5,13 +5,27 @@ Notes:
      and reduces noise in code by not having to manually
      commit or rollback the db if a exception occurs.
 """
+import logging
+import random
+import threading
+import time
+
 from contextlib import contextmanager
 
-from sqlalchemy import Boolean, Column, create_engine
+from sqlalchemy import bindparam, Boolean, Column, create_engine, event, false, Index, Integer
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext import baked
 from sqlalchemy.ext.declarative import declared_attr, declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session as BaseSession, sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.sql.expression import UpdateBase
 
-from .settings import DATABASE_URL
+from . import querylog
+from .settings import (
+    DATABASE_MAX_OVERFLOW, DATABASE_PGBOUNCER, DATABASE_POOL_PRE_PING, DATABASE_POOL_RECYCLE,
+    DATABASE_POOL_SIZE, DATABASE_POOL_TIMEOUT, DATABASE_REPLICA_CHECK_INTERVAL, DATABASE_REPLICA_MAX_LAG,
+    DATABASE_REPLICA_URLS, DATABASE_URL,
+)
 
 try:
     import __pypy__  # noqa
@@ -21,10 +35,150 @@ except ImportError:
     pass
 
 
-engine = create_engine(DATABASE_URL)
+logger = logging.getLogger()
+
+def _watch_pool(name, pool):
+    def on_checkout(_dbapi_conn, _conn_record, _conn_proxy):
+        checked_out = pool.checkedout()
+        if checked_out >= pool.size() + DATABASE_MAX_OVERFLOW:
+            logger.warning('Connection pool %s exhausted: %s connections checked out', name, checked_out)
+    event.listen(pool, 'checkout', on_checkout)
+
+def _create_engine(name, url):
+    if DATABASE_PGBOUNCER:
+        db_engine = create_engine(url, poolclass=NullPool)
+    else:
+        db_engine = create_engine(
+            url,
+            pool_size=DATABASE_POOL_SIZE,
+            max_overflow=DATABASE_MAX_OVERFLOW,
+            pool_timeout=DATABASE_POOL_TIMEOUT,
+            pool_recycle=DATABASE_POOL_RECYCLE,
+            pool_pre_ping=DATABASE_POOL_PRE_PING
+        )
+        _watch_pool(name, db_engine.pool)
+    querylog.install(db_engine)
+    return db_engine
+
+engine = _create_engine('primary', DATABASE_URL)
+
+replica_engines = [
+    _create_engine('replica_{}'.format(i), url) for i, url in enumerate(DATABASE_REPLICA_URLS)
+]
+
+def get_engines():
+    engines = [('primary', engine, )]
+    for i, replica in enumerate(replica_engines):
+        engines.append(('replica_{}'.format(i), replica, ))
+    return engines
+
+def get_pool_status():
+    """Gauges of the connection pools, keyed by engine name."""
+    status = {}
+    for name, db_engine in get_engines():
+        pool = db_engine.pool
+        if not isinstance(pool, QueuePool):
+            status[name] = {'pooling': 'external'}
+            continue
+        status[name] = {
+            'size': pool.size(),
+            'max_overflow': DATABASE_MAX_OVERFLOW,
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+        }
+    return status
+
+class ReplicaMonitor:
+    """Keeps track of the replay lag and of the last replayed sync change
+    of every replica, refreshed at most every `check_interval` seconds.
+    Replicas lagging more than `max_lag` seconds are not used.
+    """
+    STATUS_SQL = """
+        SELECT
+            CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END,
+            (SELECT COALESCE(MAX(id), 0) FROM sync_change)
+    """
+
+    def __init__(self, engines, check_interval, max_lag):
+        self.engines = engines
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.__lock = threading.Lock()
+        self.__status = {}
+        self.__checked_at = None
+
+    def __refresh(self):
+        now = time.monotonic()
+        if self.__checked_at is not None and now - self.__checked_at < self.check_interval:
+            return
+        with self.__lock:
+            if self.__checked_at is not None and now - self.__checked_at < self.check_interval:
+                return
+            status = {}
+            for replica in self.engines:
+                try:
+                    with replica.connect() as conn:
+                        lag, last_change_id = conn.execute(self.STATUS_SQL).first()
+                    status[replica] = (float(lag), last_change_id, )
+                except SQLAlchemyError:
+                    logger.warning('Replica %s is not available', replica.url)
+            self.__status = status
+            self.__checked_at = now
+
+    def get_available_engines(self):
+        if not self.engines:
+            return []
+        self.__refresh()
+        return [replica for replica, (lag, _) in self.__status.items() if lag <= self.max_lag]
+
+    def get_sync_watermark(self):
+        """Highest sync change id replayed by every available replica,
+        or None when reads are not served by replicas.
+        """
+        available = self.get_available_engines()
+        if not available:
+            return None
+        return min(self.__status[replica][1] for replica in available)
+
+replica_monitor = ReplicaMonitor(replica_engines, DATABASE_REPLICA_CHECK_INTERVAL, DATABASE_REPLICA_MAX_LAG)
+
+class RoutingSession(BaseSession):
+    """Readonly sessions read from one of the available replicas,
+    the same for the whole session. Everything else, and every statement
+    following a flush or DML, goes to the primary engine.
+    """
+    def __init__(self, readonly=False, **kwargs):
+        super().__init__(**kwargs)
+        self.readonly = readonly
+        self.has_written = False
+        self.__replica = None
+
+    def execute(self, clause, *args, **kwargs):
+        if isinstance(clause, UpdateBase):
+            self.readonly = False
+            self.has_written = True
+        return super().execute(clause, *args, **kwargs)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing:
+            self.readonly = False
+            self.has_written = True
+        if not self.readonly:
+            return engine
+        if self.__replica is None:
+            available = replica_monitor.get_available_engines()
+            self.__replica = random.choice(available) if available else engine
+        return self.__replica
+
+    @property
+    def reads_replica(self):
+        """Whether some reads went to a replica, which may lag behind the primary."""
+        return self.__replica is not None and self.__replica is not engine
 
 # Session to be used throughout app.
-Session = sessionmaker(bind=engine)
+Session = sessionmaker(bind=engine, class_=RoutingSession)
 
 class BaseModel:
     @declared_attr
@@ -37,12 +191,39 @@ class SoftDelete:
 class Fixed:
     fixed = Column(Boolean(), server_default='FALSE', nullable=False)
 
+class Versioned:
+    """The version is bumped on every update by the gam_bump_version
+    trigger, ORM updates only apply to the version they loaded.
+    """
+    version = Column(Integer, server_default='1', nullable=False)
+
+    @declared_attr
+    def __mapper_args__(self):
+        return {'version_id_col': self.version, 'version_id_generator': False}
+
+class Searchable:
+    """Text columns listed in __searchable__ get a pg_trgm GIN index,
+    so that $regex and $ilike selectors on them can avoid sequential scans.
+    """
+    __searchable__ = ()
+
+    @declared_attr
+    def __table_args__(self):
+        return tuple(
+            Index(
+                'ix_{}_{}_trgm'.format(self.__tablename__, column),
+                column,
+                postgresql_using='gin',
+                postgresql_ops={column: 'gin_trgm_ops'}
+            ) for column in self.__searchable__
+        )
+
 
 Base = declarative_base(cls=BaseModel)
 
 @contextmanager
-def scoped_session() -> Session:
-    session = Session()
+def scoped_session(readonly=False) -> Session:
+    session = Session(readonly=readonly)
     try:
         yield session
         session.commit()
@@ -51,3 +232,104 @@ def scoped_session() -> Session:
         raise
     finally:
         session.close()
+
+class RequestSession:
+    """Session shared by everything a request does, started on first use
+    and committed or rolled back once the response is ready.
+    With replicas, reads asked as readonly get a session of their own,
+    so that authentication lookups on the primary don't pin the whole
+    request to it. Once the request has written, its reads go to the
+    primary session too, so that they see the writes.
+    """
+    def __init__(self):
+        self.__sessions = {}
+        self.__on_commit = []
+
+    def get(self, readonly=False):
+        primary = self.__sessions.get(False)
+        if primary is not None and primary.has_written:
+            return primary
+        key = readonly and bool(replica_engines)
+        if key not in self.__sessions:
+            self.__sessions[key] = Session(readonly=readonly)
+        return self.__sessions[key]
+
+    def on_commit(self, callback, *args):
+        self.__on_commit.append((callback, args, ))
+
+    def finish(self, commit):
+        sessions = list(self.__sessions.values())
+        callbacks = self.__on_commit
+        self.__sessions = {}
+        self.__on_commit = []
+        try:
+            for session in sessions:
+                if commit:
+                    session.commit()
+                else:
+                    session.rollback()
+        except:  # noqa
+            for session in sessions:
+                session.rollback()
+            raise
+        finally:
+            for session in sessions:
+                session.close()
+        if commit:
+            for callback, args in callbacks:
+                callback(*args)
+
+__request_state = threading.local()
+
+def begin_request():
+    __request_state.session = RequestSession()
+    return __request_state.session
+
+def end_request(commit):
+    request = getattr(__request_state, 'session', None)
+    __request_state.session = None
+    if request is not None:
+        request.finish(commit)
+
+def on_commit(callback, *args):
+    """Calls back once the request transaction is committed,
+    right away outside of requests.
+    """
+    request = getattr(__request_state, 'session', None)
+    if request is None:
+        callback(*args)
+    else:
+        request.on_commit(callback, *args)
+
+@contextmanager
+def request_session(readonly=False) -> Session:
+    """Session of the current request, or a scoped_session outside of requests.
+    Changes are flushed when the block exits, so that errors surface
+    in the block, and committed with the request.
+    """
+    request = getattr(__request_state, 'session', None)
+    if request is None:
+        with scoped_session(readonly=readonly) as session:
+            yield session
+        return
+    session = request.get(readonly)
+    if not readonly:
+        session.readonly = False
+    try:
+        yield session
+        session.flush()
+    except:  # noqa
+        session.rollback()
+        raise
+
+__bakery = baked.bakery()
+
+def get_by_id(session, model_class, obj_id):
+    """Loads an instance by id, skipping soft deleted ones.
+    The query is baked: it is built and compiled once per model.
+    """
+    query = __bakery(lambda session: session.query(model_class), model_class)
+    query += lambda q: q.filter(model_class.id == bindparam('obj_id'))
+    if issubclass(model_class, SoftDelete):
+        query += lambda q: q.filter(model_class.deleted == false())
+    return query(session).params(obj_id=obj_id).first()
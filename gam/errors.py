@@ -1,3 +1,7 @@
 class InvalidSelectorException(RuntimeError):
     def __init__(self, message):
         self.message = message
+
+class InvalidAggregationException(RuntimeError):
+    def __init__(self, message):
+        self.message = message
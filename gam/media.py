@@ -0,0 +1,110 @@
+""" Encoding and decoding of request and response bodies.
+JSON goes through orjson, which writes bytes and natively handles
+datetimes and UUIDs. Clients preferring MessagePack get it instead,
+as negotiated from the Accept header. The handlers are registered on
+the app, so resources only set resp.media, or resp.data with bodies
+already encoded for the response content type.
+"""
+from datetime import date, time
+from decimal import Decimal
+from uuid import UUID
+
+import msgpack
+import orjson
+
+from falcon import HTTPPayloadTooLarge, MEDIA_JSON, MEDIA_MSGPACK
+from falcon.media import BaseHandler
+
+from .settings import MAX_REQUEST_BODY_SIZE
+
+# on equal preference JSON wins, as the last one
+MEDIA_TYPES = [MEDIA_MSGPACK, MEDIA_JSON]
+
+
+def __default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError('Type is not JSON serializable: {}'.format(type(obj).__name__))
+
+def __msgpack_default(obj):
+    if isinstance(obj, (date, time, )):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, UUID):
+        return str(obj)
+    raise TypeError('Type is not MessagePack serializable: {}'.format(type(obj).__name__))
+
+def dumps(obj, sort_keys=False) -> bytes:
+    option = orjson.OPT_NON_STR_KEYS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    return orjson.dumps(obj, default=__default, option=option)
+
+def loads(data):
+    """Raises ValueError on malformed documents."""
+    return orjson.loads(data)
+
+def packb(obj) -> bytes:
+    return msgpack.packb(obj, default=__msgpack_default, use_bin_type=True)
+
+def unpackb(data):
+    """Raises ValueError on malformed documents."""
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except (msgpack.UnpackException, TypeError) as e:
+        raise ValueError(str(e))
+
+def get_media_type(content_type):
+    """MEDIA_MSGPACK for MessagePack content types, MEDIA_JSON otherwise."""
+    if content_type is not None and content_type.startswith(MEDIA_MSGPACK):
+        return MEDIA_MSGPACK
+    return MEDIA_JSON
+
+def encode(obj, content_type) -> bytes:
+    if get_media_type(content_type) == MEDIA_MSGPACK:
+        return packb(obj)
+    return dumps(obj)
+
+def decode(data, content_type):
+    if get_media_type(content_type) == MEDIA_MSGPACK:
+        return unpackb(data)
+    return loads(data)
+
+def __payload_too_large():
+    return HTTPPayloadTooLarge(
+        description='The body is larger than {} bytes'.format(MAX_REQUEST_BODY_SIZE)
+    )
+
+def read_body(stream, content_length):
+    """Reads a request body of up to MAX_REQUEST_BODY_SIZE bytes,
+    raising HTTPPayloadTooLarge past it.
+    """
+    if content_length is None:
+        data = stream.read(MAX_REQUEST_BODY_SIZE + 1)
+        if len(data) > MAX_REQUEST_BODY_SIZE:
+            raise __payload_too_large()
+        return data
+    if content_length > MAX_REQUEST_BODY_SIZE:
+        raise __payload_too_large()
+    return stream.read(content_length)
+
+class JSONHandler(BaseHandler):
+    def deserialize(self, stream, content_type, content_length):
+        return loads(read_body(stream, content_length))
+
+    def serialize(self, media, content_type):
+        return dumps(media)
+
+class MessagePackHandler(BaseHandler):
+    def deserialize(self, stream, content_type, content_length):
+        return unpackb(read_body(stream, content_length))
+
+    def serialize(self, media, content_type):
+        return packb(media)
+
+def read_media(req):
+    """Decodes the JSON or MessagePack request body, raising ValueError
+    when malformed and HTTPPayloadTooLarge past MAX_REQUEST_BODY_SIZE.
+    """
+    return decode(read_body(req.stream, req.content_length or 0), req.content_type)
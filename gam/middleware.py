@@ -6,7 +6,23 @@ from jwt import InvalidTokenError
 from falcon_auth import FalconAuthMiddleware, JWTAuthBackend
 
 from users.utils import get_authenticated_user
-from gam.settings import JWT_EXPIRATION_DELTA, SECRET_KEY
+from gam import querylog
+from gam.compression import compress, compress_stream, negotiate_encoding
+from gam.database import begin_request, end_request
+from gam.media import MEDIA_TYPES
+from gam.settings import (
+    COMPRESSION_ENABLED, COMPRESSION_MIN_SIZE, JWT_EXPIRATION_DELTA, QUERY_LOG_HEADER, SECRET_KEY,
+)
+
+
+class ClaimsJWTAuthBackend(JWTAuthBackend):
+    """Keeps the decoded payload in the request context, so that
+    the claims signed into the token can be used past authentication.
+    """
+    def _decode_jwt_token(self, req):
+        payload = super()._decode_jwt_token(req)
+        req.context['token_payload'] = payload
+        return payload
 
 
 class ExpiredJWTAuthBackend(JWTAuthBackend):
@@ -39,8 +55,87 @@ class ExpiredJWTAuthBackend(JWTAuthBackend):
         return payload
 
 
-auth_backend = JWTAuthBackend(get_authenticated_user, SECRET_KEY, expiration_delta=JWT_EXPIRATION_DELTA)
+class QueryLogMiddleware:
+    """Turns the query log on for requests carrying the QUERY_LOG_HEADER header."""
+    def process_request(self, req, _resp):
+        if QUERY_LOG_HEADER is not None and req.get_header(QUERY_LOG_HEADER) is not None:
+            querylog.enable_for_request()
+
+    def process_response(self, _req, _resp, _resource, _req_succeeded):
+        querylog.reset_for_request()
+
+
+class DBSessionMiddleware:
+    """Binds one lazily started database session to each request, committed
+    unless the request failed. It is kept in req.context.db_session.
+    """
+    def process_request(self, req, _resp):
+        req.context.db_session = begin_request()
+
+    def process_response(self, _req, _resp, _resource, req_succeeded):
+        end_request(commit=req_succeeded)
+
+
+class ContentNegotiationMiddleware:
+    """Sets the response content type to the one of gam.media.MEDIA_TYPES
+    preferred by the Accept header, resources encode their bodies for it.
+    """
+    def process_request(self, req, resp):
+        resp.append_header('Vary', 'Accept')
+        media_type = req.client_prefers(MEDIA_TYPES)
+        if media_type is not None:
+            resp.content_type = media_type
+
+
+class CompressionMiddleware:
+    """Compresses bodies of at least COMPRESSION_MIN_SIZE bytes, and
+    streams as they are sent, with the encoding negotiated by gam.compression.
+    Must come first, so that it sees the response once completed.
+    """
+    compressible_types = ('text/', 'application/json', 'application/msgpack', )
+
+    def process_response(self, req, resp, _resource, _req_succeeded):
+        if not COMPRESSION_ENABLED or resp.get_header('Content-Encoding') is not None:
+            return
+        # bodies encoded with the default media type may not set it
+        content_type = resp.content_type or resp.options.default_media_type
+        if not content_type.startswith(self.compressible_types):
+            return
+        body = resp.data if resp.body is None else resp.body
+        if body is None and resp.stream is None and resp.status != falcon.HTTP_NOT_MODIFIED:
+            return
+
+        # every encoding of the representation, and the 304s revalidating
+        # it, gets the same validator whether it ends up compressed or not
+        resp.append_header('Vary', 'Accept-Encoding')
+        etag = resp.etag
+        if etag is not None and not etag.startswith('W/'):
+            resp.etag = 'W/' + etag
+
+        if req.method == 'HEAD' or body is None and resp.stream is None:
+            return
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if body is not None and len(body) < COMPRESSION_MIN_SIZE:
+            return
+        encoding = negotiate_encoding(req.get_header('Accept-Encoding'))
+        if encoding is None:
+            return
+        if body is not None:
+            resp.body = None
+            resp.data = compress(encoding, body)
+        else:
+            resp.stream = compress_stream(encoding, resp.stream)
+            resp.content_length = None
+        resp.set_header('Content-Encoding', encoding)
+
+
+auth_backend = ClaimsJWTAuthBackend(get_authenticated_user, SECRET_KEY, expiration_delta=JWT_EXPIRATION_DELTA)
 auth_expired_backend = ExpiredJWTAuthBackend(get_authenticated_user, SECRET_KEY,
     expiration_delta=JWT_EXPIRATION_DELTA,
     verify_claims=['signature', 'nbf', 'iat'])
 auth_middleware = FalconAuthMiddleware(auth_backend, exempt_routes=['/open_users'])
+compression_middleware = CompressionMiddleware()
+content_negotiation_middleware = ContentNegotiationMiddleware()
+db_session_middleware = DBSessionMiddleware()
+query_log_middleware = QueryLogMiddleware()
@@ -0,0 +1,40 @@
+"""add_trigram_indexes
+
+Revision ID: 3f1c9a7b2d44
+Revises: e8d07cc62fd4
+Create Date: 2019-10-07 10:12:41.305118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9a7b2d44'
+down_revision = 'e8d07cc62fd4'
+branch_labels = None
+depends_on = None
+
+searchable_columns = (
+    ('agile_epic', 'name', ),
+    ('agile_user_story', 'name', ),
+    ('agile_task', 'name', ),
+)
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table, column in searchable_columns:
+        op.create_index(
+            'ix_{}_{}_trgm'.format(table, column),
+            table,
+            [column],
+            unique=False,
+            postgresql_using='gin',
+            postgresql_ops={column: 'gin_trgm_ops'}
+        )
+
+
+def downgrade():
+    for table, column in reversed(searchable_columns):
+        op.drop_index('ix_{}_{}_trgm'.format(table, column), table_name=table)
@@ -0,0 +1,47 @@
+"""add_versions
+
+Revision ID: 8a2d5e6c1f37
+Revises: 3f1c9a7b2d44
+Create Date: 2019-10-14 09:31:17.520743
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a2d5e6c1f37'
+down_revision = '3f1c9a7b2d44'
+branch_labels = None
+depends_on = None
+
+versioned_tables = (
+    'agile_epic',
+    'agile_user_story',
+    'agile_task',
+)
+
+
+def upgrade():
+    op.execute("""
+    CREATE OR REPLACE FUNCTION gam_bump_version() RETURNS TRIGGER AS $$
+    BEGIN
+        NEW.version := OLD.version + 1;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE PLPGSQL;
+    """)
+    for table in versioned_tables:
+        op.add_column(table, sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+        op.execute("""
+        CREATE TRIGGER gam_bump_version_{table}_trigger
+        BEFORE UPDATE ON {table}
+        FOR EACH ROW EXECUTE PROCEDURE gam_bump_version();
+        """.format(table=table))
+
+
+def downgrade():
+    for table in reversed(versioned_tables):
+        op.execute('DROP TRIGGER gam_bump_version_{table}_trigger ON {table}'.format(table=table))
+        op.drop_column(table, 'version')
+    op.execute('DROP FUNCTION gam_bump_version()')
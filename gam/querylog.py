@@ -0,0 +1,99 @@
+""" Opt-in query log.
+Each logged statement is written through the `gam.querylog` logger
+as a JSON object with its fingerprint, bind count, duration and row count.
+Logging is enabled for the whole process with QUERY_LOG_ENABLED or for a
+single request through the QUERY_LOG_HEADER header, sampled with
+QUERY_LOG_SAMPLE_RATE and capped to QUERY_LOG_RATE_LIMIT entries per second.
+"""
+import hashlib
+import logging
+import random
+import re
+import threading
+import time
+
+from sqlalchemy import event
+
+from .media import dumps
+from .settings import QUERY_LOG_ENABLED, QUERY_LOG_HEADER, QUERY_LOG_RATE_LIMIT, QUERY_LOG_SAMPLE_RATE
+
+logger = logging.getLogger('gam.querylog')
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_BIND_LIST_RE = re.compile(r'\((?:%\([^)]+\)s(?:, )?)+\)')
+
+_request_state = threading.local()
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.__lock = threading.Lock()
+        self.__window = 0
+        self.__count = 0
+
+    def allow(self):
+        now = int(time.monotonic())
+        with self.__lock:
+            if now != self.__window:
+                self.__window = now
+                self.__count = 0
+            if self.__count >= self.rate:
+                return False
+            self.__count += 1
+            return True
+
+_rate_limiter = RateLimiter(QUERY_LOG_RATE_LIMIT)
+
+def fingerprint(statement):
+    """Hash of the statement with whitespace and expanded IN lists collapsed,
+    so that the same query always has the same fingerprint.
+    """
+    normalized = _WHITESPACE_RE.sub(' ', statement).strip()
+    normalized = _BIND_LIST_RE.sub('(...)', normalized)
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+def _count_binds(parameters, executemany):
+    if parameters is None:
+        return 0
+    if executemany:
+        return sum(len(p) for p in parameters)
+    return len(parameters)
+
+def enable_for_request(enabled=True):
+    _request_state.enabled = enabled
+
+def reset_for_request():
+    _request_state.enabled = None
+
+def is_enabled():
+    enabled = getattr(_request_state, 'enabled', None)
+    if enabled is None:
+        return QUERY_LOG_ENABLED
+    return enabled
+
+def _before_cursor_execute(_conn, _cursor, _statement, _parameters, context, _executemany):
+    if not is_enabled() or random.random() >= QUERY_LOG_SAMPLE_RATE:
+        return
+    context.query_log_start = time.perf_counter()
+
+def _after_cursor_execute(_conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'query_log_start', None)
+    if start is None:
+        return
+    duration = time.perf_counter() - start
+    if not _rate_limiter.allow():
+        return
+    entry = {
+        'fingerprint': fingerprint(statement),
+        'binds': _count_binds(parameters, executemany),
+        'duration_ms': round(duration * 1000, 3),
+        'rows': cursor.rowcount,
+    }
+    logger.info(dumps(entry).decode('utf-8'), extra={'query': entry})
+
+def install(engine):
+    if not QUERY_LOG_ENABLED and QUERY_LOG_HEADER is None:
+        return
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
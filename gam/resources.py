@@ -1,20 +1,32 @@
-import ujson as json
+import hashlib
+
+from decimal import Decimal
 
 from falcon import (
     HTTP_BAD_REQUEST, HTTP_CONFLICT, HTTP_CREATED,
-    HTTP_METHOD_NOT_ALLOWED, HTTP_NOT_FOUND,
-    HTTP_OK, MEDIA_JSON, Request, Response
+    HTTP_METHOD_NOT_ALLOWED, HTTP_NOT_FOUND, HTTP_NOT_MODIFIED,
+    HTTP_OK, HTTP_PRECONDITION_FAILED, MEDIA_JSON, MEDIA_MSGPACK, Request, Response
 )
 
+from marshmallow import ValidationError
 from marshmallow_sqlalchemy import ModelSchema
 
-from sqlalchemy import and_, false, or_, not_ as base_not_
+from sqlalchemy import and_, delete, false, func, insert, or_, not_ as base_not_, select, true, update
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import ColumnProperty
 from sqlalchemy.orm.attributes import InstrumentedAttribute
+from sqlalchemy.orm.exc import StaleDataError
 
-from users.utils import get_user_roles_map
-from .database import Base, Fixed, scoped_session, SoftDelete
-from .errors import InvalidSelectorException
+from users.utils import get_request_roles_map
+from .cache import response_cache
+from .database import Base, Fixed, get_by_id, get_pool_status, on_commit, request_session, Session, SoftDelete, Versioned
+from .errors import InvalidAggregationException, InvalidSelectorException
+from .media import dumps, encode, get_media_type, read_media
+from .statements import (
+    get_column_values, get_json_columns, get_returning_columns, get_schema_columns, group_rows_by_keys,
+    json_list_statement, next_ids_statement, values_alias,
+)
+from .utils import ClosingIterator
 
 def not_(*args):
     return base_not_(and_(*args))
@@ -22,6 +34,77 @@ def not_(*args):
 def nor_(*args):
     return base_not_(or_(*args))
 
+_REGEX_SPECIAL_CHARS = frozenset('.^$*+?()[]{}|\\')
+
+def _escape_like(char):
+    if char in ('%', '_', '\\', ):
+        return '\\' + char
+    return char
+
+def _regex_to_like(pattern):
+    """Translates a regex made only of literals, '.', '.*' and the
+    '^' / '$' anchors into an equivalent LIKE pattern.
+    Returns None when the regex uses anything else.
+    """
+    if not isinstance(pattern, str):
+        return None
+    anchored_start = pattern.startswith('^')
+    body = pattern[1:] if anchored_start else pattern
+    # a '$' preceded by an odd number of backslashes is escaped
+    anchored_end = body.endswith('$') and (len(body) - len(body[:-1].rstrip('\\'))) % 2 == 1
+    if anchored_end:
+        body = body[:-1]
+    like = []
+    i = 0
+    body_len = len(body)
+    while i < body_len:
+        char = body[i]
+        if char == '\\':
+            if i + 1 >= body_len or body[i + 1].isalnum():
+                return None
+            like.append(_escape_like(body[i + 1]))
+            i += 2
+        elif body.startswith('.*', i):
+            like.append('%')
+            i += 2
+        elif char == '.':
+            like.append('_')
+            i += 1
+        elif char in _REGEX_SPECIAL_CHARS:
+            return None
+        else:
+            like.append(_escape_like(char))
+            i += 1
+    return '{}{}{}'.format(
+        '' if anchored_start else '%',
+        ''.join(like),
+        '' if anchored_end else '%'
+    )
+
+def regex_(column, pattern):
+    # ILIKE on simple patterns is cheaper than ~* and both are
+    # served by the pg_trgm indexes of Searchable models
+    like = _regex_to_like(pattern)
+    if like is None:
+        return column.op('~*')(pattern)
+    return column.ilike(like, escape='\\')
+
+def _get_etag(version, content_type):
+    """ETag of a version of an item, told apart by media type as in "3-msgpack"."""
+    if get_media_type(content_type) == MEDIA_MSGPACK:
+        return '"{}-msgpack"'.format(version)
+    return '"{}"'.format(version)
+
+def _strip_weak(value):
+    value = value.strip()
+    if value.startswith('W/'):
+        value = value[2:]
+    return value
+
+def _parse_etag(value):
+    """Reads the version out of an ETag like "3", W/"3" or "3-msgpack"."""
+    return int(_strip_weak(value).strip('"').partition('-')[0])
+
 class ModelBaseResource:
     model_class = Base
     permissions = ()
@@ -30,6 +113,9 @@ class ModelBaseResource:
         return session.query(self.model_class)
 
     def _can_create(self, req: Request, ctx, new_obj):
+        return self._can_create_all(req, ctx, [new_obj])
+
+    def _can_create_all(self, req: Request, ctx, new_objs):
         perms_num = len(self.permissions)
         if perms_num == 0:
             return True
@@ -38,9 +124,10 @@ class ModelBaseResource:
             'model': self.model_class,
             'user': req.context.user,
         })
-        for perm in self.permissions:
-            if not perm.can_create(ctx, new_obj):
-                return False
+        for new_obj in new_objs:
+            for perm in self.permissions:
+                if not perm.can_create(ctx, new_obj):
+                    return False
         return True
 
     def _apply_permissions(self, req: Request, ctx, query):
@@ -57,37 +144,132 @@ class ModelBaseResource:
         
         return query
 
+    def _get_permissions_clause(self, req: Request, ctx, session):
+        """Permission filters as a WHERE clause usable in UPDATE/DELETE statements."""
+        perms_num = len(self.permissions)
+        if perms_num == 0:
+            return true()
+        query = self._apply_permissions(req, ctx, self.get_base_query(session))
+        return self.model_class.id.in_(query.with_entities(self.model_class.id).statement)
+
+    def _get_cache_key(self, req: Request, *params):
+        """Identifies a read response by its params and by what the
+        permissions let the user see: users with the same roles share
+        entries unless a permission filters on the user itself.
+        """
+        if not response_cache.is_enabled(self.model_class.__tablename__):
+            return None
+        scope = {}
+        perms_num = len(self.permissions)
+        if perms_num > 0:
+            scope['roles'] = self.__get_user_roles(req)
+            if any(getattr(perm, 'user_scoped', True) for perm in self.permissions):
+                scope['user'] = req.context.user.id
+        key = dumps([type(self).__name__, params, scope], sort_keys=True)
+        return hashlib.sha1(key).hexdigest()
+
+    def _get_cached_response(self, req: Request, resp: Response, *params):
+        """Returns the cached body, if any, and the token to cache a fresh one with.
+        Bodies are cached per content type of the response.
+        """
+        key = self._get_cache_key(req, get_media_type(resp.content_type), *params)
+        return response_cache.lookup(self.model_class.__tablename__, key)
+
+    def _store_cached_response(self, session, cache_token, body):
+        # a replica may not have replayed yet the write that invalidated the entry
+        if not session.reads_replica:
+            response_cache.store(cache_token, body)
+
+    def _invalidate_cache(self):
+        on_commit(response_cache.invalidate, self.model_class.__tablename__)
+
     def __get_user_roles(self, req: Request):
-        return get_user_roles_map(req.context.user.id)
+        return get_request_roles_map(req)
 
 class ModelListResource(ModelBaseResource):
     schema_class = ModelSchema
     schema_classes = {}
+    stream_batch_size = 500
+    # lets Postgres render the lists of schemas made of plain columns
+    db_json_rendering = True
 
     def get_list_schema_class(self):
         raise NotImplementedError
 
-    def _apply_limit(self, query, params):
+    def _dump_list(self, session, query, count, schema_class, content_type, sort_columns=()):
+        """Encodes the {"count": ..., "results": [...]} document of a bounded list,
+        sort_columns being the _get_sort_columns() the query is sorted by.
+        """
+        json_columns = None
+        if self.db_json_rendering and get_media_type(content_type) == MEDIA_JSON:
+            json_columns = get_json_columns(self.model_class, schema_class)
+        if not json_columns:
+            items = schema_class().dump(query, many=True)
+            return encode({'count': count, 'results': items}, content_type)
+        results = session.execute(json_list_statement(query, json_columns, sort_columns)).scalar()
+        return '{{"count":{},"results":{}}}'.format(count, results).encode('utf-8')
+
+    def _get_limit(self, params):
         default_limit = 20
         try:
-            limit = int(params.get('limit', default_limit))
-        except TypeError:
-            limit = default_limit
-        if limit in (0, -1, ):
+            return int(params.get('limit', default_limit))
+        except (TypeError, ValueError):
+            return default_limit
+
+    def _is_unbounded(self, params):
+        return self._get_limit(params) in (0, -1, )
+
+    def _is_streamed(self, resp: Response, params):
+        # MessagePack arrays start with their length, unknown until the end
+        return self._is_unbounded(params) and get_media_type(resp.content_type) == MEDIA_JSON
+
+    def _apply_limit(self, query, params):
+        if self._is_unbounded(params):
             return query
-        return query.limit(limit)
+        return query.limit(self._get_limit(params))
+
+    def _stream_list(self, resp: Response, build_query, schema_class):
+        """Sends an unbounded list as a streamed {"count": ..., "results": [...]}
+        document. build_query(session) must return the (query, count) pair;
+        the session stays open until the stream is exhausted or closed,
+        whether or not it was iterated.
+        """
+        session = Session(readonly=True)
+        try:
+            query, count = build_query(session)
+        except:  # noqa
+            session.close()
+            raise
+        resp.stream = ClosingIterator(self.__iter_list(session, query, schema_class, count), session.close)
+
+    def __iter_list(self, session, query, schema_class, count):
+        try:
+            yield '{{"count":{},"results":['.format(count).encode('utf-8')
+            schema = schema_class()
+            separator = b''
+            rows = query.execution_options(stream_results=True).yield_per(self.stream_batch_size)
+            for instance in rows:
+                yield separator + dumps(schema.dump(instance))
+                separator = b','
+            yield b']}'
+            session.commit()
+        except:  # noqa
+            session.rollback()
+            raise
+        finally:
+            session.close()
     
     def _apply_offset(self, query, params):
         default_offset = 0
         try:
             offset = int(params.get('offset', default_offset))
-        except TypeError:
+        except (TypeError, ValueError):
             offset = default_offset
         return query.offset(offset)
     
-    def _apply_sort(self, query, params):
+    def _get_sort_entries(self, params):
         if 'sort' not in params:
-            return query
+            return
         sort_arr = params['sort'] if isinstance(params['sort'], list) else [params['sort']]
         for sort_str in sort_arr:
             sorts = sort_str.split(',')
@@ -96,27 +278,48 @@ class ModelListResource(ModelBaseResource):
                     continue
                 parts = sort.split(':')
                 parts_len = len(parts)
-                if parts_len != 2:
-                    continue
-                attr = getattr(self.model_class, parts[0], None)
-                if attr is None or not isinstance(attr, InstrumentedAttribute):
+                if parts_len != 2 or parts[1] not in ('asc', 'desc', ):
                     continue
-                if parts[1] == 'asc':
-                    query = query.order_by(attr)
-                elif parts[1] == 'desc':
-                    query = query.order_by(attr.desc())
+                yield parts[0], parts[1]
+
+    def _get_sort_columns(self, params):
+        """The (attribute, descending) pairs the list is sorted by."""
+        columns = []
+        for field, direction in self._get_sort_entries(params):
+            attr = getattr(self.model_class, field, None)
+            if attr is None or not isinstance(attr, InstrumentedAttribute):
+                continue
+            columns.append((attr, direction == 'desc', ))
+        return columns
+
+    def _apply_sort(self, query, params):
+        for attr, descending in self._get_sort_columns(params):
+            query = query.order_by(attr.desc() if descending else attr)
         return query
 
+class PoolStatusResource:
+    def on_get(self, _req: Request, resp: Response):
+        """Connection pools gauges.
+        ---
+        get:
+            description: Size, checked out and overflow connections of every database engine
+            responses:
+                200:
+                    description: Pools status keyed by engine name
+        """
+        resp.status = HTTP_OK
+        resp.media = get_pool_status()
+
 class ModelDeleteAllResource(ModelBaseResource):
     def on_post(self, req: Request, resp: Response):
         try:
-            params = json.loads(req.stream.read(req.content_length or 0))
+            params = read_media(req)
             ids = params['ids']
         except (KeyError, TypeError, ValueError):
             resp.status = HTTP_BAD_REQUEST
             return
         
-        with scoped_session() as session:
+        with request_session() as session:
             query = self._apply_permissions(req, {'method': 'delete'}, self.get_base_query(session))
             qf = [self.model_class.id.in_(ids), ]
             is_soft_delete = issubclass(self.model_class, SoftDelete)
@@ -127,6 +330,7 @@ class ModelDeleteAllResource(ModelBaseResource):
                 query.update({'deleted': True})
             else:
                 query.delete(synchronize_session=False)
+        self._invalidate_cache()
         resp.status = HTTP_OK
 
 class ModelQueryResource(ModelListResource):
@@ -144,7 +348,8 @@ class ModelQueryResource(ModelListResource):
         # '$size': '',
         # '$mod': '',
         '$contains': lambda x,y: x.any(x.property.entity.class_.id == y),
-        '$regex': lambda x,y: getattr(x, 'op')('~*')(y)
+        '$regex': regex_,
+        '$ilike': lambda x,y: getattr(x, 'ilike')(y),
     }
     CONDITION_OPERATORS_KEYS = CONDITION_OPERATORS.keys()
 
@@ -158,6 +363,15 @@ class ModelQueryResource(ModelListResource):
     }
     COMBINATION_OPERATORS_KEYS = COMBINATION_OPERATORS.keys()
 
+    AGGREGATION_OPERATORS = {
+        '$count': func.count,
+        '$sum': func.sum,
+        '$avg': func.avg,
+        '$min': func.min,
+        '$max': func.max,
+    }
+    AGGREGATION_OPERATORS_KEYS = AGGREGATION_OPERATORS.keys()
+
     def __init__(self, model_class, schema_class):
         self.model_class = model_class
         self.list_schema_class = schema_class
@@ -201,44 +415,119 @@ class ModelQueryResource(ModelListResource):
         
         return query
 
+    def __get_group_field(self, field):
+        attr = getattr(self.model_class, field.replace('.', '__'), None) if isinstance(field, str) else None
+        # relationships can't be grouped by
+        if (attr is None or not isinstance(attr, InstrumentedAttribute) or
+                not isinstance(attr.property, ColumnProperty)):
+            raise InvalidAggregationException('{} has no {} field'.format(self.model_class, field))
+        return attr
+
+    def __decode_group(self, group):
+        if not isinstance(group, dict):
+            raise InvalidAggregationException('Invalid group definition')
+        by_fields = group.get('by', [])
+        if not isinstance(by_fields, list):
+            by_fields = [by_fields]
+        columns = [(field, self.__get_group_field(field), ) for field in by_fields]
+        aggregates = []
+        for alias in group:
+            if alias == 'by':
+                continue
+            entry = group[alias]
+            if not isinstance(entry, dict) or len(entry) != 1:
+                raise InvalidAggregationException('Invalid accumulator {}'.format(alias))
+            operator, field = next(iter(entry.items()))
+            if operator not in self.AGGREGATION_OPERATORS_KEYS:
+                raise InvalidAggregationException('Invalid accumulator operator {}'.format(operator))
+            if operator == '$count' and field in (None, '*', ):
+                aggregates.append(func.count().label(alias))
+            else:
+                aggregates.append(
+                    self.AGGREGATION_OPERATORS[operator](self.__get_group_field(field)).label(alias)
+                )
+        aggregates_num = len(aggregates)
+        if aggregates_num == 0:
+            raise InvalidAggregationException('No accumulators in group definition')
+        return columns, aggregates
+
+    def __apply_group(self, query, params):
+        columns, aggregates = self.__decode_group(params['group'])
+        query = query.with_entities(
+            *[attr.label(field) for field, attr in columns], *aggregates
+        ).group_by(*[attr for _, attr in columns])
+        count = query.count()
+        sortable = {field: attr for field, attr in columns}
+        sortable.update({agg.name: agg for agg in aggregates})
+        for field, direction in self._get_sort_entries(params):
+            if field not in sortable:
+                continue
+            query = query.order_by(sortable[field] if direction == 'asc' else sortable[field].desc())
+        query = self._apply_limit(query, params)
+        query = self._apply_offset(query, params)
+        return query, count
+
+    def __dump_group_row(self, row):
+        item = row._asdict()
+        for key in item:
+            if isinstance(item[key], Decimal):
+                item[key] = float(item[key])
+        return item
+
+    def __build_query(self, req: Request, session, params):
+        query = self._apply_permissions(req, {'method': 'list'}, self.get_base_query(session))
+        count = query.count()
+        if issubclass(self.model_class, SoftDelete):
+            query = query.filter(self.model_class.deleted == false())
+        query = self.__apply_selector(query, params)
+        if 'group' in params:
+            return self.__apply_group(query, params)
+        query = self._apply_sort(query, params)
+        query = self._apply_limit(query, params)
+        query = self._apply_offset(query, params)
+        return query, count
+
     def on_post(self, req: Request, resp: Response):
         try:
-            params = json.loads(req.stream.read(req.content_length or 0))
+            params = read_media(req)
         except (TypeError, ValueError):
             resp.status = HTTP_BAD_REQUEST
             return
         
         schema_class = self.get_list_schema_class()
+        is_group = 'group' in params
 
-        with scoped_session() as session:
-            query = self._apply_permissions(req, {'method': 'list'}, self.get_base_query(session))
-            count = query.count()
-            if issubclass(self.model_class, SoftDelete):
-                query = query.filter(self.model_class.deleted == false())
-            try:
-                query = self.__apply_selector(query, params)
-            except InvalidSelectorException as e:
-                resp.status = HTTP_BAD_REQUEST
-                resp.body = json.dumps({
-                    'error': e.message
-                })
+        try:
+            if not is_group and self._is_streamed(resp, params):
+                self._stream_list(resp, lambda session: self.__build_query(req, session, params), schema_class)
                 return
-            query = self._apply_sort(query, params)
-            query = self._apply_limit(query, params)
-            query = self._apply_offset(query, params)
-            from sqlalchemy.dialects import postgresql
-            print(str(query.statement.compile(dialect=postgresql.dialect())))
-            items = schema_class().dump(
-                query,
-                many=True
-            )
-        resp.body = json.dumps({
-            'count': count,
-            'results': items.data
-        })
+            body, cache_token = self._get_cached_response(req, resp, 'query', params)
+            if body is not None:
+                resp.data = body
+                return
+            with request_session(readonly=True) as session:
+                query, count = self.__build_query(req, session, params)
+                if is_group:
+                    body = encode({
+                        'count': count,
+                        'results': [self.__dump_group_row(row) for row in query]
+                    }, resp.content_type)
+                else:
+                    body = self._dump_list(
+                        session, query, count, schema_class, resp.content_type, self._get_sort_columns(params)
+                    )
+        except (InvalidAggregationException, InvalidSelectorException) as e:
+            resp.status = HTTP_BAD_REQUEST
+            resp.media = {
+                'error': e.message
+            }
+            return
+        resp.data = body
+        self._store_cached_response(session, cache_token, resp.data)
 
 class ModelResource(ModelListResource):
     uri = None
+    bulk_max_items = 500
 
     @classmethod
     def register_endpoints(cls, base_url, app, resource):
@@ -253,6 +542,7 @@ class ModelResource(ModelListResource):
         app.add_route(base_url, resource)
         app.add_route('{}/{{obj_id}}'.format(base_url), resource)
         app.add_route('{}/delete_all'.format(base_url), dah)
+        app.add_route('{}/bulk'.format(base_url), resource, suffix='bulk')
         app.add_route('{}/query'.format(base_url), qh)
 
     def on_get(self, req: Request, resp: Response, obj_id=None):
@@ -298,38 +588,53 @@ class ModelResource(ModelListResource):
             return
         
         schema_class = self.__get_schema_class('post')
+        schema_columns = get_schema_columns(self.model_class, schema_class)
+        has_hooks = self.__overrides('_process_create_data') or self.__overrides('_post_create')
 
-        # try:
-        with scoped_session() as session:
-            input_data = json.loads(req.stream.read(req.content_length or 0))
+        try:
+            input_data = read_media(req)
+            self.__pop_versions([input_data])
             if not self._can_create(req, {'method': 'create'}, input_data):
                 resp.status = HTTP_METHOD_NOT_ALLOWED
                 return
-            self._process_create_data(input_data)
-            
-            item, errors = schema_class().load(
-                input_data,
-                session=session
-            )
-            if errors is not None:
-                errors_num = len(errors)
-                if errors_num > 0:
-                    resp.status = HTTP_BAD_REQUEST
-                    resp.body = json.dumps({'errors': errors})
-                    return
-            session.add(item)
-            session.commit()
+            with request_session() as session:
+                if has_hooks or schema_columns is None:
+                    extra = self._process_create_data(input_data)
+                    item = schema_class().load(
+                        input_data,
+                        session=session
+                    )
+                    session.add(item)
+                    session.flush()
 
-            self._post_create(session, item)
+                    self._post_create(session, item, extra)
 
-            itm_id = item.id
-            item_dump, _ = schema_class().dump(item)
+                    itm_id = item.id
+                    item_dump = schema_class().dump(item)
+                else:
+                    instance = schema_class().load(input_data, session=session, transient=True)
+                    table = self.model_class.__table__
+                    returning = get_returning_columns(schema_columns)
+                    returning.append(table.c.id.label('_id'))
+                    row = session.execute(
+                        insert(table).values(
+                            get_column_values(schema_columns, instance, input_data)
+                        ).returning(*returning)
+                    ).first()
+                    itm_id = row['_id']
+                    item_dump = schema_class().dump(row)
+        except ValidationError as e:
+            resp.status = HTTP_BAD_REQUEST
+            resp.media = {'errors': e.messages}
+            return
+        except (TypeError, ValueError, IntegrityError):
+            resp.status = HTTP_BAD_REQUEST
+            return
+        self._invalidate_cache()
         
         resp.status = HTTP_CREATED
         resp.append_header('Location', self.__get_item_url(req, itm_id))
-        resp.body = json.dumps(item_dump)
-        # except (TypeError, ValueError, IntegrityError):
-        #     resp.status = HTTP_BAD_REQUEST
+        resp.media = item_dump
     
     def on_put(self, req: Request, resp: Response, obj_id=None):
         """Generic PUT endpoint.
@@ -362,48 +667,192 @@ class ModelResource(ModelListResource):
             return
         
         schema_class = self.__get_schema_class('delete')
+        schema_columns = get_schema_columns(self.model_class, schema_class)
         
         try:
             nid = int(obj_id)
         except (TypeError, ValueError):
             resp.status = HTTP_BAD_REQUEST
-            resp.body = '{"message": "Invalid id"}'
+            resp.media = {'message': 'Invalid id'}
             return
         
-        with scoped_session() as session:
-            query = self._apply_permissions(req, {'method': 'delete'}, self.get_base_query(session))
-            qf = [self.model_class.id == nid, ]
-            is_soft_delete = issubclass(self.model_class, SoftDelete)
-            if is_soft_delete:
-                qf.append(self.model_class.deleted == false())
-            item = query.filter(*qf).first()
-            if item is None:
-                resp.status = HTTP_NOT_FOUND
-                return
-            if issubclass(self.model_class, Fixed) and item.fixed:
-                resp.status = HTTP_CONFLICT
-                resp.body = '{"message": "the resource is marked as \'fixed\', hence it could not be deleted"}'
-                return
-            if is_soft_delete:
-                item.deleted = True
-                session.add(item)
+        is_soft_delete = issubclass(self.model_class, SoftDelete)
+        is_fixed = issubclass(self.model_class, Fixed)
+        with request_session() as session:
+            if schema_columns is None:
+                item = self.__get_instance(req, session, 'delete', nid)
+                if item is None:
+                    resp.status = HTTP_NOT_FOUND
+                    return
+                if is_fixed and item.fixed:
+                    resp.status = HTTP_CONFLICT
+                    resp.media = {'message': "the resource is marked as 'fixed', hence it could not be deleted"}
+                    return
+                if is_soft_delete:
+                    item.deleted = True
+                    session.add(item)
+                else:
+                    session.delete(item)
+                item_dump = schema_class().dump(item)
             else:
-                session.delete(item)
-            item_dump, _ = schema_class().dump(item)
+                table = self.model_class.__table__
+                qf = [
+                    table.c.id == nid,
+                    self._get_permissions_clause(req, {'method': 'delete'}, session),
+                ]
+                if is_soft_delete:
+                    qf.append(table.c.deleted == false())
+                if is_fixed:
+                    qf.append(table.c.fixed == false())
+                if is_soft_delete:
+                    stmt = update(table).where(and_(*qf)).values({'deleted': True})
+                else:
+                    stmt = delete(table).where(and_(*qf))
+                row = session.execute(stmt.returning(*get_returning_columns(schema_columns))).first()
+                if row is None:
+                    # nothing deleted: either missing or fixed
+                    if is_fixed and self.__get_instance(req, session, 'delete', nid) is not None:
+                        resp.status = HTTP_CONFLICT
+                        resp.media = {'message': "the resource is marked as 'fixed', hence it could not be deleted"}
+                    else:
+                        resp.status = HTTP_NOT_FOUND
+                    return
+                item_dump = schema_class().dump(row)
+        self._invalidate_cache()
         
         resp.status = HTTP_OK
-        resp.body = json.dumps(item_dump)
+        resp.media = item_dump
     
+    def on_post_bulk(self, req: Request, resp: Response):
+        """Creates a list of objects in a single transaction."""
+        items = self.__read_bulk_payload(req, resp)
+        if items is None:
+            return
+        self.__pop_versions(items)
+        if not self._can_create_all(req, {'method': 'create'}, items):
+            resp.status = HTTP_METHOD_NOT_ALLOWED
+            return
+
+        schema_class = self.__get_schema_class('post')
+        schema_columns = get_schema_columns(self.model_class, schema_class)
+        has_hooks = self.__overrides('_process_create_data') or self.__overrides('_post_create')
+
+        try:
+            with request_session() as session:
+                if has_hooks or schema_columns is None:
+                    instances = []
+                    for input_data in items:
+                        extra = self._process_create_data(input_data)
+                        instance = schema_class().load(input_data, session=session)
+                        session.add(instance)
+                        session.flush()
+                        self._post_create(session, instance, extra)
+                        instances.append(instance)
+                    items_dump = schema_class().dump(instances, many=True)
+                else:
+                    instances = schema_class().load(items, many=True, session=session, transient=True)
+                    rows = [
+                        get_column_values(schema_columns, instance, input_data)
+                        for instance, input_data in zip(instances, items)
+                    ]
+                    table = self.model_class.__table__
+                    ids = session.execute(next_ids_statement(table, len(rows))).fetchall()
+                    for row, (nid, ) in zip(rows, ids):
+                        row['id'] = nid
+                    returning = get_returning_columns(schema_columns)
+                    if 'id' not in schema_columns:
+                        returning.append(table.c.id.label('id'))
+                    created = [None] * len(rows)
+                    for _, group in group_rows_by_keys(rows):
+                        result = session.execute(
+                            insert(table).values([row for _, row in group]).returning(*returning)
+                        )
+                        positions = {row['id']: position for position, row in group}
+                        for row in result.fetchall():
+                            created[positions[row['id']]] = row
+                    items_dump = schema_class().dump(created, many=True)
+        except ValidationError as e:
+            resp.status = HTTP_BAD_REQUEST
+            resp.media = {'errors': e.messages}
+            return
+        except IntegrityError:
+            resp.status = HTTP_BAD_REQUEST
+            return
+        self._invalidate_cache()
+
+        resp.status = HTTP_CREATED
+        resp.media = items_dump
+
+    def on_put_bulk(self, req: Request, resp: Response):
+        """Updates a list of objects, identified by their id, in a single transaction."""
+        self.__update_items(req, resp, 'put', False)
+
+    def on_patch_bulk(self, req: Request, resp: Response):
+        self.__update_items(req, resp, 'patch', True)
+
+    def on_delete_bulk(self, req: Request, resp: Response):
+        """Deletes the objects whose ids are listed in the payload.
+        Missing, forbidden and fixed objects are skipped.
+        """
+        try:
+            params = read_media(req)
+            ids = [int(i) for i in params['ids']]
+        except (KeyError, TypeError, ValueError):
+            resp.status = HTTP_BAD_REQUEST
+            return
+        ids_num = len(ids)
+        if ids_num > self.bulk_max_items:
+            resp.status = HTTP_BAD_REQUEST
+            resp.media = {'message': 'Too many items, max {}'.format(self.bulk_max_items)}
+            return
+
+        schema_class = self.__get_schema_class('delete')
+        schema_columns = get_schema_columns(self.model_class, schema_class)
+        table = self.model_class.__table__
+        is_soft_delete = issubclass(self.model_class, SoftDelete)
+
+        with request_session() as session:
+            qf = [
+                self.model_class.id.in_(ids),
+                self._get_permissions_clause(req, {'method': 'delete'}, session),
+            ]
+            if is_soft_delete:
+                qf.append(self.model_class.deleted == false())
+            if issubclass(self.model_class, Fixed):
+                qf.append(self.model_class.fixed == false())
+            if schema_columns is None:
+                instances = self.get_base_query(session).filter(*qf).all()
+                for instance in instances:
+                    if is_soft_delete:
+                        instance.deleted = True
+                        session.add(instance)
+                    else:
+                        session.delete(instance)
+                items_dump = schema_class().dump(instances, many=True)
+            else:
+                if is_soft_delete:
+                    stmt = update(table).where(and_(*qf)).values({'deleted': True})
+                else:
+                    stmt = delete(table).where(and_(*qf))
+                result = session.execute(stmt.returning(*get_returning_columns(schema_columns)))
+                items_dump = schema_class().dump(result.fetchall(), many=True)
+        self._invalidate_cache()
+
+        resp.status = HTTP_OK
+        resp.media = items_dump
+
+    # the value returned by a _process_*_data hook is handed to the matching
+    # _post_* hook of the same item, resources are shared between requests
     def _process_update_data(self, data, input_data):
         pass
     
-    def _post_update(self, session, instance):
+    def _post_update(self, session, instance, extra=None):
         pass
     
     def _process_create_data(self, data):
         pass
     
-    def _post_create(self, session, instance):
+    def _post_create(self, session, instance, extra=None):
         pass
     
     def __update_item(self, req: Request, resp: Response, obj_id, method, partial): # pylint: disable=too-many-arguments,too-many-locals
@@ -415,49 +864,291 @@ class ModelResource(ModelListResource):
             nid = int(obj_id)
         except (TypeError, ValueError):
             resp.status = HTTP_BAD_REQUEST
-            resp.body = '{"message": "Invalid id"}'
+            resp.media = {'message': 'Invalid id'}
             return
         
         schema_class = self.__get_schema_class(method)
+        schema_columns = get_schema_columns(self.model_class, schema_class)
+        has_hooks = self.__overrides('_process_update_data') or self.__overrides('_post_update')
 
         try:
-            with scoped_session() as session:
-                query = self._apply_permissions(req, {'method': 'update'}, self.get_base_query(session))
-                qf = [self.model_class.id == nid, ]
-                if issubclass(self.model_class, SoftDelete):
-                    qf.append(self.model_class.deleted == false())
-                item = query.filter(*qf).first()
-                if item is None:
-                    resp.status = HTTP_NOT_FOUND
-                    return
-                if item.id != nid:
-                    resp.status = HTTP_BAD_REQUEST
-                    return
-                input_data = json.loads(req.stream.read(req.content_length or 0))
-                self._process_update_data(item, input_data)
-                upd, errors = schema_class().load(
-                    input_data,
-                    session=session,
-                    instance=item,
-                    partial=partial
-                )
-                if errors is not None:
-                    errors_num = len(errors)
-                    if errors_num > 0:
+            input_data = read_media(req)
+            expected_version = self.__pop_expected_version(req, input_data)
+            with request_session() as session:
+                if has_hooks or schema_columns is None:
+                    item = self.__get_instance(req, session, 'update', nid)
+                    if item is None:
+                        resp.status = HTTP_NOT_FOUND
+                        return
+                    if expected_version is not None and item.version != expected_version:
+                        self.__version_mismatch(resp, item.version)
+                        return
+                    extra = self._process_update_data(item, input_data)
+                    upd = schema_class().load(
+                        input_data,
+                        session=session,
+                        instance=item,
+                        partial=partial
+                    )
+                    if upd.id != nid:
+                        session.rollback()
                         resp.status = HTTP_BAD_REQUEST
-                        resp.body = json.dumps({'errors': errors})
                         return
-                session.add(upd)
+                    session.add(upd)
 
-                self._post_update(session, upd)
+                    self._post_update(session, upd, extra)
+                    session.flush()
 
-                item_dump, _ = schema_class().dump(item)
+                    item_dump = schema_class().dump(upd)
+                    version = upd.version if isinstance(upd, Versioned) else None
+                else:
+                    # a single UPDATE ... RETURNING, filtered by the permissions
+                    instance = schema_class().load(input_data, session=session, partial=partial, transient=True)
+                    values = get_column_values(schema_columns, instance, input_data)
+                    table = self.model_class.__table__
+                    qf = [
+                        table.c.id == nid,
+                        self._get_permissions_clause(req, {'method': 'update'}, session),
+                    ]
+                    if issubclass(self.model_class, SoftDelete):
+                        qf.append(table.c.deleted == false())
+                    returning = get_returning_columns(schema_columns)
+                    if expected_version is not None:
+                        qf.append(table.c.version == expected_version)
+                    if issubclass(self.model_class, Versioned):
+                        returning.append(table.c.version.label('_version'))
+                    values_num = len(values)
+                    if values_num == 0:
+                        result = session.execute(select(returning).where(and_(*qf)))
+                    else:
+                        result = session.execute(update(table).where(and_(*qf)).values(values).returning(*returning))
+                    row = result.first()
+                    if row is None:
+                        current = None
+                        if expected_version is not None:
+                            current = self.__get_instance(req, session, 'update', nid)
+                        if current is None:
+                            resp.status = HTTP_NOT_FOUND
+                        else:
+                            self.__version_mismatch(resp, current.version)
+                        return
+                    item_dump = schema_class().dump(row)
+                    version = row['_version'] if issubclass(self.model_class, Versioned) else None
+            self._invalidate_cache()
             
             resp.status = HTTP_OK
-            resp.body = json.dumps(item_dump)
+            resp.media = item_dump
+            self.__set_etag(resp, version)
+        except StaleDataError:
+            # updated by someone else since it was loaded
+            resp.status = HTTP_PRECONDITION_FAILED
+            resp.media = {'message': 'Version mismatch'}
+        except ValidationError as e:
+            resp.status = HTTP_BAD_REQUEST
+            resp.media = {'errors': e.messages}
         except (TypeError, ValueError, IntegrityError):
             resp.status = HTTP_BAD_REQUEST
     
+    def __pop_expected_version(self, req: Request, input_data):
+        """The version the client means to update, from If-Match or the payload."""
+        if not issubclass(self.model_class, Versioned):
+            return None
+        version = input_data.pop('version', None) if isinstance(input_data, dict) else None
+        if_match = req.get_header('If-Match')
+        if if_match is not None and if_match.strip() != '*':
+            version = _parse_etag(if_match)
+        return None if version is None else int(version)
+
+    def __pop_versions(self, items):
+        """Takes the (dump only) versions out of the payloads, by item."""
+        if not issubclass(self.model_class, Versioned):
+            return [None] * len(items)
+        return [item.pop('version', None) if isinstance(item, dict) else None for item in items]
+
+    def __versions_conflict(self, resp: Response, conflicts):
+        resp.status = HTTP_PRECONDITION_FAILED
+        resp.media = {
+            'message': 'Version mismatch',
+            'conflicts': [{'id': nid, 'version': version} for nid, version in conflicts],
+        }
+
+    def __version_mismatch(self, resp: Response, version):
+        resp.status = HTTP_PRECONDITION_FAILED
+        resp.media = {'message': 'Version mismatch', 'version': version}
+        self.__set_etag(resp, version)
+
+    def __set_etag(self, resp: Response, version):
+        if version is not None:
+            resp.etag = _get_etag(version, resp.content_type)
+
+    def __get_instance(self, req: Request, session, method, nid):
+        perms_num = len(self.permissions)
+        if perms_num == 0 and not self.__overrides('get_base_query'):
+            return get_by_id(session, self.model_class, nid)
+        query = self._apply_permissions(req, {'method': method}, self.get_base_query(session))
+        qf = [self.model_class.id == nid, ]
+        if issubclass(self.model_class, SoftDelete):
+            qf.append(self.model_class.deleted == false())
+        return query.filter(*qf).first()
+
+    def __overrides(self, method_name):
+        return getattr(type(self), method_name) is not getattr(ModelResource, method_name)
+
+    def __read_bulk_payload(self, req: Request, resp: Response):
+        try:
+            items = read_media(req)
+        except (TypeError, ValueError):
+            items = None
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            resp.status = HTTP_BAD_REQUEST
+            resp.media = {'message': 'A list of objects is required'}
+            return None
+        items_num = len(items)
+        if items_num > self.bulk_max_items:
+            resp.status = HTTP_BAD_REQUEST
+            resp.media = {'message': 'Too many items, max {}'.format(self.bulk_max_items)}
+            return None
+        return items
+
+    def __update_items(self, req: Request, resp: Response, method, partial):
+        items = self.__read_bulk_payload(req, resp)
+        if items is None:
+            return
+        try:
+            ids = [int(item['id']) for item in items]
+        except (KeyError, TypeError, ValueError):
+            resp.status = HTTP_BAD_REQUEST
+            resp.media = {'message': 'Invalid id'}
+            return
+        ids_num = len(ids)
+        if len(set(ids)) != ids_num:
+            resp.status = HTTP_BAD_REQUEST
+            resp.media = {'message': 'Duplicated id'}
+            return
+        try:
+            versions = [None if version is None else int(version) for version in self.__pop_versions(items)]
+        except (TypeError, ValueError):
+            resp.status = HTTP_BAD_REQUEST
+            resp.media = {'message': 'Invalid version'}
+            return
+
+        schema_class = self.__get_schema_class(method)
+        schema_columns = get_schema_columns(self.model_class, schema_class)
+        has_hooks = self.__overrides('_process_update_data') or self.__overrides('_post_update')
+
+        try:
+            with request_session() as session:
+                qf = [self.model_class.id.in_(ids), ]
+                if issubclass(self.model_class, SoftDelete):
+                    qf.append(self.model_class.deleted == false())
+                if has_hooks or schema_columns is None:
+                    query = self._apply_permissions(req, {'method': 'update'}, self.get_base_query(session))
+                    instances = {instance.id: instance for instance in query.filter(*qf)}
+                    missing = [i for i in ids if i not in instances]
+                    missing_num = len(missing)
+                    if missing_num > 0:
+                        resp.status = HTTP_NOT_FOUND
+                        resp.media = {'missing': missing}
+                        return
+                    conflicts = [
+                        (nid, instances[nid].version) for nid, version in zip(ids, versions)
+                        if version is not None and instances[nid].version != version
+                    ]
+                    conflicts_num = len(conflicts)
+                    if conflicts_num > 0:
+                        self.__versions_conflict(resp, conflicts)
+                        return
+                    updated = []
+                    for nid, input_data in zip(ids, items):
+                        extra = self._process_update_data(instances[nid], input_data)
+                        upd = schema_class().load(
+                            input_data,
+                            session=session,
+                            instance=instances[nid],
+                            partial=partial
+                        )
+                        session.add(upd)
+                        self._post_update(session, upd, extra)
+                        updated.append(upd)
+                    # the UPDATEs are conditional on the loaded versions
+                    session.flush()
+                    items_dump = schema_class().dump(updated, many=True)
+                else:
+                    loaded = schema_class().load(
+                        items, many=True, session=session, partial=partial, transient=True
+                    )
+                    rows = []
+                    for nid, version, instance, input_data in zip(ids, versions, loaded, items):
+                        row = get_column_values(schema_columns, instance, input_data)
+                        row['id'] = nid
+                        if version is not None:
+                            row['version'] = version
+                        rows.append(row)
+                    table = self.model_class.__table__
+                    qf.append(self._get_permissions_clause(req, {'method': 'update'}, session))
+                    returning = get_returning_columns(schema_columns)
+                    if 'id' not in schema_columns:
+                        returning.append(table.c.id.label('id'))
+                    updated = [None] * len(rows)
+                    for keys, group in group_rows_by_keys(rows):
+                        values = values_alias(table, keys, [row for _, row in group])
+                        gqf = [table.c.id == values.c.id, ]
+                        if 'version' in keys:
+                            gqf.append(table.c.version == values.c.version)
+                        stmt = update(table).where(and_(*gqf, *qf))
+                        set_keys = [key for key in keys if key not in ('id', 'version', )]
+                        set_keys_num = len(set_keys)
+                        if set_keys_num == 0:
+                            result = session.execute(select(returning).where(and_(*gqf, *qf)))
+                        else:
+                            result = session.execute(
+                                stmt.values({key: values.c[key] for key in set_keys}).returning(*returning)
+                            )
+                        positions = {row['id']: position for position, row in group}
+                        for row in result.fetchall():
+                            updated[positions[row['id']]] = row
+                    missing = [nid for nid, row in zip(ids, updated) if row is None]
+                    missing_num = len(missing)
+                    if missing_num > 0:
+                        session.rollback()
+                        conflicts = self.__get_versions_conflicts(req, session, missing, ids, versions)
+                        conflicts_num = len(conflicts)
+                        if conflicts_num > 0:
+                            self.__versions_conflict(resp, conflicts)
+                        else:
+                            resp.status = HTTP_NOT_FOUND
+                            resp.media = {'missing': missing}
+                        return
+                    items_dump = schema_class().dump(updated, many=True)
+            self._invalidate_cache()
+
+            resp.status = HTTP_OK
+            resp.media = items_dump
+        except StaleDataError:
+            # updated by someone else since they were loaded
+            resp.status = HTTP_PRECONDITION_FAILED
+            resp.media = {'message': 'Version mismatch'}
+        except ValidationError as e:
+            resp.status = HTTP_BAD_REQUEST
+            resp.media = {'errors': e.messages}
+        except (TypeError, ValueError, IntegrityError):
+            resp.status = HTTP_BAD_REQUEST
+
+    def __get_versions_conflicts(self, req: Request, session, missing, ids, versions):
+        """Among the items left out by a bulk UPDATE, the (id, version) of
+        those existing with another version than expected.
+        """
+        expected = {nid: version for nid, version in zip(ids, versions) if version is not None and nid in missing}
+        expected_num = len(expected)
+        if expected_num == 0:
+            return []
+        query = self._apply_permissions(req, {'method': 'update'}, self.get_base_query(session))
+        qf = [self.model_class.id.in_(list(expected)), ]
+        if issubclass(self.model_class, SoftDelete):
+            qf.append(self.model_class.deleted == false())
+        rows = query.filter(*qf).with_entities(self.model_class.id, self.model_class.version)
+        return [(nid, version) for nid, version in rows if version != expected[nid]]
+
     def __get_item_url(self, req: Request, obj_id):
         return '{}://{}{}/{}'.format(
             req.scheme,
@@ -472,55 +1163,70 @@ class ModelResource(ModelListResource):
         return self.schema_class
     
     def __get_item(self, req: Request, resp: Response, obj_id):
-        resp.content_type = MEDIA_JSON
-
         try:
             nid = int(obj_id)
         except (TypeError, ValueError):
             resp.status = HTTP_BAD_REQUEST
-            resp.body = '{"message": "Invalid id"}'
+            resp.media = {'message': 'Invalid id'}
             return
 
         schema_class = self.__get_schema_class('get')
 
-        with scoped_session() as session:
-            query = self._apply_permissions(req, {'method': 'get'}, self.get_base_query(session))
-            qf = [self.model_class.id == nid, ]
-            if issubclass(self.model_class, SoftDelete):
-                qf.append(self.model_class.deleted == false())
-            q = query.filter(*qf)
-            q = self._apply_permissions(req, {'method': 'get'}, q)
-            instance = q.first()
-            if instance is None:
-                resp.status = HTTP_NOT_FOUND
+        cached, cache_token = self._get_cached_response(req, resp, 'get', nid)
+        if cached is not None:
+            body, version = cached
+        else:
+            with request_session(readonly=True) as session:
+                instance = self.__get_instance(req, session, 'get', nid)
+                if instance is None:
+                    resp.status = HTTP_NOT_FOUND
+                    return
+                body = encode(schema_class().dump(instance), resp.content_type)
+                version = instance.version if isinstance(instance, Versioned) else None
+            self._store_cached_response(session, cache_token, (body, version, ))
+
+        self.__set_etag(resp, version)
+        if_none_match = req.get_header('If-None-Match')
+        if version is not None and if_none_match is not None:
+            # weak comparison, the ETag of the other media type doesn't match
+            if _strip_weak(resp.etag) in [_strip_weak(tag) for tag in if_none_match.split(',')]:
+                resp.status = HTTP_NOT_MODIFIED
+                resp.content_type = None
                 return
-            item, _ = schema_class().dump(instance)
         resp.status = HTTP_OK
-        resp.body = json.dumps(item)
+        resp.data = body
     
     def get_list_schema_class(self):
         return self.__get_schema_class('list')
     
+    def __build_list_query(self, req: Request, session, params):
+        query = self._apply_permissions(req, {'method': 'list'}, self.get_base_query(session))
+        count = query.count()
+        if issubclass(self.model_class, SoftDelete):
+            query = query.filter(self.model_class.deleted == false())
+        query = self._apply_sort(query, params)
+        query = self._apply_limit(query, params)
+        query = self._apply_offset(query, params)
+        return query, count
+
     def __list_items(self, req: Request, resp: Response):
-        resp.content_type = MEDIA_JSON
         resp.status = HTTP_OK
         params = req.params
 
         schema_class = self.get_list_schema_class()
 
-        with scoped_session() as session:
-            query = self._apply_permissions(req, {'method': 'list'}, self.get_base_query(session))
-            count = query.count()
-            if issubclass(self.model_class, SoftDelete):
-                query = query.filter(self.model_class.deleted == false())
-            query = self._apply_sort(query, params)
-            query = self._apply_limit(query, params)
-            query = self._apply_offset(query, params)
-            items = schema_class().dump(
-                query,
-                many=True
+        if self._is_streamed(resp, params):
+            self._stream_list(resp, lambda session: self.__build_list_query(req, session, params), schema_class)
+            return
+
+        body, cache_token = self._get_cached_response(req, resp, 'list', params)
+        if body is not None:
+            resp.data = body
+            return
+
+        with request_session(readonly=True) as session:
+            query, count = self.__build_list_query(req, session, params)
+            resp.data = self._dump_list(
+                session, query, count, schema_class, resp.content_type, self._get_sort_columns(params)
             )
-        resp.body = json.dumps({
-            'count': count,
-            'results': items
-        })
+        self._store_cached_response(session, cache_token, resp.data)
@@ -0,0 +1,124 @@
+""" Helpers compiling ModelResource operations into single
+Core statements (INSERT/UPDATE/DELETE ... RETURNING) that skip
+the ORM unit of work.
+"""
+from sqlalchemy import Boolean, cast, Float, func, Integer, literal, select, String, Text, union_all
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.inspection import inspect
+
+# column types rendered by Postgres exactly as the schemas dump them
+JSON_SAFE_TYPES = (Boolean, Float, Integer, String, )
+
+__schema_columns = {}
+__json_columns = {}
+
+def get_schema_columns(model_class, schema_class):
+    """Maps every field of the schema to the model column backing it.
+    Returns None when a field is not a plain column (nested, method...),
+    as such schemas can't be dumped from statement results.
+    """
+    key = (model_class, schema_class, )
+    if key not in __schema_columns:
+        mapper = inspect(model_class)
+        columns = {}
+        for name, field in schema_class().fields.items():
+            attr_name = field.attribute or name
+            if attr_name not in mapper.column_attrs:
+                columns = None
+                break
+            columns[attr_name] = mapper.column_attrs[attr_name].columns[0]
+        __schema_columns[key] = columns
+    return __schema_columns[key]
+
+def get_json_columns(model_class, schema_class):
+    """Maps every dumped key of the schema to the model column backing it.
+    Returns None unless they all are plain columns of JSON_SAFE_TYPES.
+    """
+    key = (model_class, schema_class, )
+    if key not in __json_columns:
+        mapper = inspect(model_class)
+        columns = {}
+        for name, field in schema_class().dump_fields.items():
+            attr_name = field.attribute or name
+            if attr_name not in mapper.column_attrs:
+                columns = None
+                break
+            column = mapper.column_attrs[attr_name].columns[0]
+            if not isinstance(column.type, JSON_SAFE_TYPES):
+                columns = None
+                break
+            columns[field.data_key or name] = column
+        __json_columns[key] = columns
+    return __json_columns[key]
+
+def json_list_statement(query, json_columns, order_by=()):
+    """Wraps a filtered, sorted and limited list query into a statement
+    selecting its rows already rendered as a JSON array. order_by lists
+    the (column, descending) pairs the query is sorted by, which the
+    aggregate sorts by again as the subquery order is not kept.
+    """
+    sort_labels = ['_sort_{}'.format(i) for i in range(len(order_by))]
+    rows = query.with_entities(*(
+        [column.label(name) for name, column in json_columns.items()] +
+        [column.label(label) for label, (column, _) in zip(sort_labels, order_by)]
+    )).subquery('rows')
+    pairs = []
+    for name in json_columns:
+        pairs += [literal(name), rows.c[name]]
+    item = func.json_build_object(*pairs)
+    if order_by:
+        item = aggregate_order_by(item, *[
+            rows.c[label].desc() if descending else rows.c[label]
+            for label, (_, descending) in zip(sort_labels, order_by)
+        ])
+    return select([
+        func.coalesce(cast(func.json_agg(item), Text), '[]')
+    ]).select_from(rows)
+
+def get_returning_columns(schema_columns):
+    return [column.label(attr_name) for attr_name, column in schema_columns.items()]
+
+def get_column_values(schema_columns, instance, keys):
+    """Collects the column values of a transient instance loaded by the
+    schema, limited to the keys actually sent by the client.
+    """
+    values = {}
+    for attr_name, column in schema_columns.items():
+        if attr_name in keys and not column.primary_key:
+            values[column.key] = getattr(instance, attr_name)
+    return values
+
+def next_ids_statement(table, count):
+    """Selects count values of the sequence of the id column. Multi-row
+    INSERT ... RETURNING doesn't return rows in VALUES order, so rows
+    inserted together are given their ids beforehand and matched by id.
+    """
+    return select([
+        func.nextval(func.pg_get_serial_sequence(table.name, 'id'))
+    ]).select_from(func.generate_series(1, count))
+
+def group_rows_by_keys(rows):
+    """Multi-row statements need the same columns on every row,
+    so rows are grouped by the set of keys they carry.
+    Yields (keys, [(position, row), ...]).
+    """
+    groups = {}
+    for position, row in enumerate(rows):
+        groups.setdefault(tuple(sorted(row.keys())), []).append((position, row, ))
+    for keys, group in groups.items():
+        yield keys, group
+
+def values_alias(table, keys, rows, name='bulk_values'):
+    """Builds the equivalent of (VALUES (...), (...)) AS name (keys)
+    with explicitly typed columns, to be used in UPDATE ... FROM.
+    """
+    selects = [
+        select([
+            cast(literal(row[key], table.c[key].type), table.c[key].type).label(key)
+            for key in keys
+        ]) for row in rows
+    ]
+    selects_num = len(selects)
+    if selects_num == 1:
+        return selects[0].alias(name)
+    return union_all(*selects).alias(name)
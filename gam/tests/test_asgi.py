@@ -0,0 +1,75 @@
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+
+from gam.asgi import WSGIHandler
+
+
+def __run(scope, messages, max_body_size=1024):
+    calls = []
+    sent = []
+
+    def wsgi_app(environ, start_response):
+        calls.append(environ['wsgi.input'].read())
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'ok']
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    asyncio.run(WSGIHandler(wsgi_app, executor, max_body_size)(scope, receive, send))
+    executor.shutdown()
+    return calls, sent
+
+def __http_scope():
+    return {
+        'type': 'http', 'method': 'POST', 'path': '/', 'query_string': b'', 'headers': [],
+    }
+
+
+# -------- HTTP -----------------------
+# the body is read in full before the app is called
+def test_http_body():
+    calls, sent = __run(__http_scope(), [
+        {'type': 'http.request', 'body': b'ab', 'more_body': True},
+        {'type': 'http.request', 'body': b'c'},
+    ])
+    assert calls == [b'abc']
+    assert sent[0]['status'] == 200
+    assert b''.join(message.get('body', b'') for message in sent[1:]) == b'ok'
+
+# a client leaving mid body never reaches the app
+def test_http_disconnect():
+    calls, sent = __run(__http_scope(), [
+        {'type': 'http.request', 'body': b'ab', 'more_body': True},
+        {'type': 'http.disconnect'},
+    ])
+    assert calls == []
+    assert sent == []
+
+def test_http_too_large():
+    calls, sent = __run(__http_scope(), [
+        {'type': 'http.request', 'body': b'abc'},
+    ], max_body_size=2)
+    assert calls == []
+    assert sent[0]['status'] == 413
+
+
+# -------- Other scopes ---------------
+def test_lifespan():
+    _, sent = __run({'type': 'lifespan'}, [
+        {'type': 'lifespan.startup'},
+        {'type': 'lifespan.shutdown'},
+    ])
+    assert [message['type'] for message in sent] == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+
+def test_websocket_rejected():
+    calls, sent = __run({'type': 'websocket', 'path': '/'}, [
+        {'type': 'websocket.connect'},
+    ])
+    assert calls == []
+    assert [message['type'] for message in sent] == ['websocket.close']
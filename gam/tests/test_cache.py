@@ -0,0 +1,101 @@
+import pytest
+
+from gam import cache
+from gam.cache import ResponseCache, TTLCache
+
+
+class Watcher:
+    def __init__(self):
+        self.listeners = []
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def poll(self):
+        pass
+
+    def notify(self, table_name, object_id=None):
+        for listener in self.listeners:
+            listener(table_name, object_id)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    return now
+
+@pytest.fixture
+def watcher(monkeypatch):
+    monkeypatch.setattr(cache, 'get_sync_model', lambda table_name: (
+        (object, object, (), ) if table_name in ('a', 'b', ) else (None, None, None, )
+    ))
+    return Watcher()
+
+
+# -------- TTL cache ------------------
+def test_ttl_cache_expires(clock):
+    entries = TTLCache(10, 5)
+    entries.set('k', 1)
+    clock[0] += 5
+    assert entries.get('k') == 1
+    clock[0] += 1
+    assert entries.get('k') is None
+    assert entries.get('k', 2) == 2
+
+# the least recently used entry goes first
+def test_ttl_cache_lru(clock):
+    entries = TTLCache(2, 5)
+    entries.set('a', 1)
+    entries.set('b', 2)
+    entries.get('a')
+    entries.set('c', 3)
+    assert entries.get('a') == 1
+    assert entries.get('b') is None
+    assert entries.get('c') == 3
+
+
+# -------- Response cache -------------
+def __fill(responses, table_name, key, body):
+    cached, token = responses.lookup(table_name, key)
+    assert cached is None
+    responses.store(token, body)
+
+def test_response_cache_hit(clock, watcher):
+    responses = ResponseCache(True, 10, 5, watcher)
+    __fill(responses, 'a', 'k', b'1')
+    assert responses.lookup('a', 'k') == (b'1', None, )
+
+# a change of the table drops its entries, and only its entries
+def test_response_cache_invalidate(clock, watcher):
+    responses = ResponseCache(True, 10, 5, watcher)
+    __fill(responses, 'a', 'k', b'1')
+    __fill(responses, 'b', 'k', b'2')
+    responses.invalidate('a')
+    assert responses.lookup('a', 'k')[0] is None
+    assert responses.lookup('b', 'k')[0] == b'2'
+
+# bodies read before a change are not stored under the new generation
+def test_response_cache_stale_store(clock, watcher):
+    responses = ResponseCache(True, 10, 5, watcher)
+    _, token = responses.lookup('a', 'k')
+    watcher.notify('a', 1)
+    responses.store(token, b'old')
+    assert responses.lookup('a', 'k')[0] is None
+
+# too many changes to list drop everything
+def test_response_cache_invalidate_all(clock, watcher):
+    responses = ResponseCache(True, 10, 5, watcher)
+    __fill(responses, 'a', 'k', b'1')
+    __fill(responses, 'b', 'k', b'2')
+    watcher.notify(None)
+    assert responses.lookup('a', 'k')[0] is None
+    assert responses.lookup('b', 'k')[0] is None
+
+# tables not tracked by sync_change, and disabled caches, are never cached
+@pytest.mark.parametrize('enabled, table_name', [(True, 'untracked'), (False, 'a')])
+def test_response_cache_disabled(clock, watcher, enabled, table_name):
+    responses = ResponseCache(enabled, 10, 5, watcher)
+    assert responses.lookup(table_name, 'k') == (None, None, )
+    responses.store(None, b'1')
+    assert responses.lookup(table_name, 'k') == (None, None, )
@@ -0,0 +1,89 @@
+import gzip
+import io
+
+import falcon
+import pytest
+
+from falcon import testing
+
+from gam import compression, middleware
+from gam.compression import compress, compress_stream, GzipCompressor, negotiate_encoding
+from gam.middleware import CompressionMiddleware
+
+
+@pytest.fixture
+def encodings(monkeypatch):
+    monkeypatch.setattr(compression, 'ENCODINGS', {
+        'br': GzipCompressor, 'zstd': GzipCompressor, 'gzip': GzipCompressor,
+    })
+
+
+# -------- Negotiation ----------------
+@pytest.mark.parametrize('header, encoding', [
+    (None, None),
+    ('', None),
+    ('identity', None),
+    ('gzip', 'gzip'),
+    ('GZIP', 'gzip'),
+    ('gzip, br', 'br'),
+    ('gzip;q=1, br;q=0.5', 'gzip'),
+    ('br;q=0.5, zstd;q=0.5, gzip;q=0.5', 'br'),
+    ('br;q=0, gzip', 'gzip'),
+    ('gzip;q=0', None),
+    ('*', 'br'),
+    ('*;q=0.5, br;q=0.1', 'zstd'),
+    ('*, br;q=0, zstd;q=0', 'gzip'),
+    ('gzip;q=x, br;q=0.1', 'br'),
+])
+def test_negotiate_encoding(encodings, header, encoding):
+    assert negotiate_encoding(header) == encoding
+
+
+# -------- Compression ----------------
+def test_compress():
+    assert gzip.decompress(compress('gzip', b'abc' * 100)) == b'abc' * 100
+
+# iterables and file-like streams are compressed as they are read
+@pytest.mark.parametrize('stream', [
+    [b'abc' * 100, b'', b'def' * 100],
+    io.BytesIO(b'abc' * 100 + b'def' * 100),
+])
+def test_compress_stream(stream):
+    compressed = compress_stream('gzip', stream, chunk_size=64)
+    assert gzip.decompress(b''.join(compressed)) == b'abc' * 100 + b'def' * 100
+
+# the wrapped stream is closed with the compressed one, even unread
+def test_compress_stream_close():
+    stream = io.BytesIO(b'abc')
+    compress_stream('gzip', stream).close()
+    assert stream.closed
+
+
+# -------- Middleware -----------------
+class Resource:
+    def on_get(self, req, resp):
+        resp.data = b'x' * int(req.params['size'])
+        resp.etag = '"1"'
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(middleware, 'COMPRESSION_ENABLED', True)
+    monkeypatch.setattr(middleware, 'COMPRESSION_MIN_SIZE', 100)
+    app = falcon.API(middleware=[CompressionMiddleware()])
+    app.add_route('/', Resource())
+    return testing.TestClient(app)
+
+# bodies under the threshold are sent as is, with the same validator
+@pytest.mark.parametrize('size, encoding', [(99, None), (100, 'gzip')])
+def test_compression_threshold(client, size, encoding):
+    response = client.simulate_get('/', params={'size': size}, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers.get('content-encoding') == encoding
+    assert response.headers['vary'] == 'Accept-Encoding'
+    assert response.headers['etag'] == 'W/"1"'
+    body = gzip.decompress(response.content) if encoding else response.content
+    assert body == b'x' * size
+
+def test_compression_not_accepted(client):
+    response = client.simulate_get('/', params={'size': 100}, headers={'Accept-Encoding': 'gzip;q=0'})
+    assert 'content-encoding' not in response.headers
+    assert response.content == b'x' * 100
@@ -0,0 +1,34 @@
+from sqlalchemy import false, update
+
+from gam import database
+from gam.database import RequestSession
+from sync.models import Change
+
+
+# -------- Request session ------------
+# with replicas, reads have a session of their own until the request writes
+def test_reads_follow_writes(monkeypatch):
+    monkeypatch.setattr(database, 'replica_engines', [database.engine])
+    request = RequestSession()
+    try:
+        read = request.get(readonly=True)
+        write = request.get()
+        assert read is not write
+        assert request.get(readonly=True) is read
+        write.execute(update(Change.__table__).where(false()).values(object_id=0))
+        assert write.has_written
+        assert request.get(readonly=True) is write
+    finally:
+        request.finish(commit=False)
+
+# a flush is a write as well
+def test_reads_follow_flushes(monkeypatch):
+    monkeypatch.setattr(database, 'replica_engines', [database.engine])
+    request = RequestSession()
+    try:
+        write = request.get()
+        write.add(Change(table_name='test', object_id=0, entry_type='insert'))
+        write.flush()
+        assert request.get(readonly=True) is write
+    finally:
+        request.finish(commit=False)
@@ -0,0 +1,32 @@
+import pytest
+
+from falcon import MEDIA_JSON, MEDIA_MSGPACK
+
+from gam.resources import _get_etag, _parse_etag
+
+
+# -------- ETags ----------------------
+@pytest.mark.parametrize('value, version', [
+    ('"3"', 3),
+    (' "3" ', 3),
+    ('W/"3"', 3),
+    ('"3-msgpack"', 3),
+    ('W/"12-msgpack"', 12),
+])
+def test_parse_etag(value, version):
+    assert _parse_etag(value) == version
+
+@pytest.mark.parametrize('value', ['', '"x"', 'W/', '"-msgpack"', '*'])
+def test_parse_etag_invalid(value):
+    with pytest.raises(ValueError):
+        _parse_etag(value)
+
+# every media type has ETags of its own, which read back as the version
+@pytest.mark.parametrize('content_type, etag', [
+    (MEDIA_JSON, '"3"'),
+    (None, '"3"'),
+    (MEDIA_MSGPACK, '"3-msgpack"'),
+])
+def test_get_etag(content_type, etag):
+    assert _get_etag(3, content_type) == etag
+    assert _parse_etag(etag) == 3
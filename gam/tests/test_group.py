@@ -0,0 +1,30 @@
+import pytest
+
+from gam.errors import InvalidAggregationException
+from gam.resources import ModelQueryResource
+from users.models import User
+from users.schemas import UserSchema
+
+
+def __decode_group(group):
+    return ModelQueryResource(User, UserSchema)._ModelQueryResource__decode_group(group)
+
+
+# -------- Group ----------------------
+# columns can be grouped by and accumulated
+def test_group_by_column():
+    columns, aggregates = __decode_group({'by': 'is_active', 'n': {'$count': '*'}, 'last': {'$max': 'id'}})
+    assert [field for field, _ in columns] == ['is_active']
+    assert [aggregate.name for aggregate in aggregates] == ['n', 'last']
+
+# relationships and unknown fields are rejected, as the SQL would be invalid
+@pytest.mark.parametrize('group', [
+    {'by': 'roles', 'n': {'$count': '*'}},
+    {'by': 'is_active', 'n': {'$max': 'roles'}},
+    {'by': 'nope', 'n': {'$count': '*'}},
+    {'by': 'is_active'},
+    {'by': 'is_active', 'n': {'$median': 'id'}},
+])
+def test_group_invalid(group):
+    with pytest.raises(InvalidAggregationException):
+        __decode_group(group)
@@ -0,0 +1,49 @@
+import io
+
+import pytest
+
+from falcon import HTTPPayloadTooLarge, MEDIA_JSON, MEDIA_MSGPACK
+
+from gam import media
+from gam.media import JSONHandler, MessagePackHandler, packb, read_body
+
+
+@pytest.fixture
+def max_size(monkeypatch):
+    monkeypatch.setattr(media, 'MAX_REQUEST_BODY_SIZE', 8)
+    return 8
+
+
+# -------- Body size ------------------
+# bodies up to the limit are read, with or without a Content-Length
+@pytest.mark.parametrize('content_length', [8, None])
+def test_read_body(max_size, content_length):
+    assert read_body(io.BytesIO(b'x' * max_size), content_length) == b'x' * max_size
+
+# the declared length is trusted, the stream isn't read past it
+def test_read_body_content_length(max_size):
+    assert read_body(io.BytesIO(b'abcdef'), 3) == b'abc'
+
+@pytest.mark.parametrize('content_length', [9, None])
+def test_read_body_too_large(max_size, content_length):
+    with pytest.raises(HTTPPayloadTooLarge):
+        read_body(io.BytesIO(b'x' * (max_size + 1)), content_length)
+
+# the media handlers apply the same limit
+@pytest.mark.parametrize('handler, content_type, body', [
+    (JSONHandler(), MEDIA_JSON, b'[1,2,3,4]'),
+    (MessagePackHandler(), MEDIA_MSGPACK, packb(list(range(8)))),
+])
+def test_handlers_too_large(max_size, handler, content_type, body):
+    assert len(body) > max_size
+    with pytest.raises(HTTPPayloadTooLarge):
+        handler.deserialize(io.BytesIO(body), content_type, len(body))
+    with pytest.raises(HTTPPayloadTooLarge):
+        handler.deserialize(io.BytesIO(body), content_type, None)
+
+@pytest.mark.parametrize('handler, content_type, body', [
+    (JSONHandler(), MEDIA_JSON, b'[1,2]'),
+    (MessagePackHandler(), MEDIA_MSGPACK, packb([1, 2])),
+])
+def test_handlers(max_size, handler, content_type, body):
+    assert handler.deserialize(io.BytesIO(body), content_type, len(body)) == [1, 2]
@@ -0,0 +1,52 @@
+import pytest
+
+from sqlalchemy import column
+from sqlalchemy.dialects import postgresql
+
+from gam.resources import _regex_to_like, regex_
+
+
+# -------- Regex to LIKE --------------
+# literals, '.', '.*' and the anchors translate to LIKE patterns
+@pytest.mark.parametrize('pattern, like', [
+    ('abc', '%abc%'),
+    ('^abc', 'abc%'),
+    ('abc$', '%abc'),
+    ('^abc$', 'abc'),
+    ('a.c', '%a_c%'),
+    ('a.*c', '%a%c%'),
+    ('^.*$', '%'),
+    ('', '%%'),
+])
+def test_regex_to_like(pattern, like):
+    assert _regex_to_like(pattern) == like
+
+# LIKE wildcards and the escape character are matched literally
+@pytest.mark.parametrize('pattern, like', [
+    ('50%', '%50\\%%'),
+    ('a_b', '%a\\_b%'),
+    ('a\\\\b', '%a\\\\b%'),
+    ('a\\.b', '%a.b%'),
+    ('a\\.\\*', '%a.*%'),
+    ('^\\^a', '^a%'),
+    ('a\\$', '%a$%'),
+    ('\\%', '%\\%%'),
+    ('a\\\\$', '%a\\\\'),
+])
+def test_regex_to_like_escaping(pattern, like):
+    assert _regex_to_like(pattern) == like
+
+# anything else is left to the regex operator
+@pytest.mark.parametrize('pattern', [
+    'a+', 'a?', 'a*', '[ab]', 'a|b', '(a)', 'a{2}', 'a^b', 'a$b',
+    '\\d', '\\w+', 'a\\', None, 3,
+])
+def test_regex_to_like_fallback(pattern):
+    assert _regex_to_like(pattern) is None
+
+def __compile(clause):
+    return str(clause.compile(dialect=postgresql.dialect()))
+
+def test_regex_operator():
+    assert 'ILIKE' in __compile(regex_(column('name'), '^abc'))
+    assert '~*' in __compile(regex_(column('name'), '^ab+c'))
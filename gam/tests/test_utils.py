@@ -0,0 +1,68 @@
+from gam.utils import ClosingIterator
+
+
+class Stream:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.closed = 0
+
+    def __iter__(self):
+        return self.chunks
+
+    def close(self):
+        self.closed += 1
+
+
+# -------- Closing iterator -----------
+def test_closing_iterator():
+    stream = Stream([b'a', b'b'])
+    closed = []
+    iterator = ClosingIterator(stream, lambda: closed.append(True))
+    assert list(iterator) == [b'a', b'b']
+    iterator.close()
+    assert stream.closed == 1
+    assert closed == [True]
+
+# closing an unread stream still closes what it wraps, once
+def test_closing_iterator_unread():
+    stream = Stream([b'a'])
+    closed = []
+    iterator = ClosingIterator(stream, lambda: closed.append(True))
+    iterator.close()
+    iterator.close()
+    assert stream.closed == 1
+    assert closed == [True]
+
+# generators that never started are closed too
+def test_closing_iterator_generator():
+    closed = []
+
+    def chunks():
+        try:
+            yield b'a'
+        finally:
+            closed.append('generator')
+
+    iterator = ClosingIterator(chunks(), lambda: closed.append('callback'))
+    assert next(iterator) == b'a'
+    iterator.close()
+    assert closed == ['generator', 'callback']
+
+# the callback runs even when closing the iterable fails
+def test_closing_iterator_close_error():
+    class FailingStream(Stream):
+        def close(self):
+            raise RuntimeError()
+
+    closed = []
+    iterator = ClosingIterator(FailingStream([]), lambda: closed.append(True))
+    try:
+        iterator.close()
+    except RuntimeError:
+        pass
+    assert closed == [True]
+
+def test_closing_iterator_without_callback():
+    stream = Stream([])
+    ClosingIterator(stream).close()
+    assert stream.closed == 1
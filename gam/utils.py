@@ -41,3 +41,33 @@ def smart_bytes(string_like, encoding='utf-8', strings_only=False, errors='stric
     If strings_only is True, don't convert (some) non-string-like objects.
     """
     return force_bytes(string_like, encoding, strings_only, errors)
+
+
+class ClosingIterator:
+    """Response stream closing the wrapped iterable and calling on_close
+    once closed. WSGI servers close streams even when they never iterated
+    them, which generators only notice when started.
+    """
+    def __init__(self, iterable, on_close=None):
+        self.__iterable = iterable
+        self.__iterator = iter(iterable)
+        self.__on_close = on_close
+        self.__closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.__iterator)
+
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        try:
+            close = getattr(self.__iterable, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            if self.__on_close is not None:
+                self.__on_close()
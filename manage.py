@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 import argparse
-import ujson as json
+import json
 
 from os import path
 
@@ -51,6 +51,11 @@ def run_app(_args):
     wsgi_app.cfg.set('reload', True)
     wsgi_app.run()
 
+def run_asgi_app(_args):
+    import uvicorn
+    from gam.asgi import create_asgi_app
+    uvicorn.run(create_asgi_app(), host='127.0.0.1', port=8000)
+
 def test(args):
     import pytest
     import gam.models  # noqa
@@ -189,6 +194,32 @@ def encpass(args):
     password = args.password
     print(make_password(password))
 
+def bench_hasher(args):
+    import os
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from gam.settings import HASHER_MAX_PENDING, HASHER_POOL_SIZE
+    from users.hasher import HasherBusy, make_password, verify_password
+
+    encoded = make_password('benchmark')
+
+    def login(_):
+        try:
+            return verify_password('benchmark', encoded)
+        except HasherBusy:
+            return None
+
+    start = time.perf_counter()
+    # by default as many clients as the pool accepts, to measure throughput rather than rejections
+    with ThreadPoolExecutor(max_workers=args.clients or HASHER_MAX_PENDING) as executor:
+        results = list(executor.map(login, range(args.logins)))
+    elapsed = time.perf_counter() - start
+    done = sum(1 for r in results if r)
+    cores = os.cpu_count() or 1
+    print('{} logins in {:.2f}s, {} rejected as busy'.format(done, elapsed, results.count(None)))
+    print('{:.1f} logins/s, {:.1f} logins/s/core ({} cores, {} hashing threads)'.format(
+        done / elapsed, done / elapsed / cores, cores, HASHER_POOL_SIZE))
+
 def manage():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
@@ -199,6 +230,9 @@ def manage():
     parser_run = subparsers.add_parser('run')
     parser_run.set_defaults(func=run_app)
 
+    parser_run_asgi = subparsers.add_parser('run_asgi')
+    parser_run_asgi.set_defaults(func=run_asgi_app)
+
     parser_makemigration = subparsers.add_parser('makemigration')
     parser_makemigration.add_argument('migration_name')
     parser_makemigration.set_defaults(func=make_migration)
@@ -235,6 +269,11 @@ def manage():
     parser_encpass.add_argument('password')
     parser_encpass.set_defaults(func=encpass)
 
+    parser_bench_hasher = subparsers.add_parser('bench_hasher')
+    parser_bench_hasher.add_argument('--logins', '-n', type=int, default=200)
+    parser_bench_hasher.add_argument('--clients', '-c', type=int, default=None)
+    parser_bench_hasher.set_defaults(func=bench_hasher)
+
     args = parser.parse_args()
     if hasattr(args, 'func'):
         args.func(args)
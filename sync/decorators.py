@@ -5,12 +5,12 @@ from marshmallow_sqlalchemy import ModelSchema
 from sqlalchemy.exc import NoInspectionAvailable
 from sqlalchemy.inspection import inspect
 
-from .triggers import check_triggers
+from .triggers import check_related_triggers, check_triggers
 from .utils import register_sync_model
 logger = logging.getLogger()
 
 
-def _sync_model(cls, permissions=()):
+def _sync_model(cls, permissions=(), related=()):
     try:
         if not issubclass(cls, ModelSchema):
             logger.info('Class %s is not a valid model schema', cls.__name__)
@@ -23,6 +23,8 @@ def _sync_model(cls, permissions=()):
         if tables_num > 0:
             table = mapper.tables[0]
             check_triggers(model_class)
+            for related_class, foreign_key in related:
+                check_related_triggers(model_class, related_class, foreign_key)
             register_sync_model(table.name, model_class, cls, permissions)
             logger.info('Class %s registered as sync model', model_class.__name__)
         return cls
@@ -31,9 +33,9 @@ def _sync_model(cls, permissions=()):
 
     return cls
 
-def sync_model(cls=None, permissions=()):
+def sync_model(cls=None, permissions=(), related=()):
     if cls is None:
         def wrapper(cls):
-            return _sync_model(cls, permissions=permissions)
+            return _sync_model(cls, permissions=permissions, related=related)
         return wrapper
     return _sync_model(cls)
@@ -1,4 +1,4 @@
-import ujson as json
+from gam.media import dumps
 
 class InvalidSyncEntry(Exception):
     def __init__(self, table_name, sync_entry):
@@ -8,7 +8,7 @@ class InvalidSyncEntry(Exception):
         self.__sync_entry = sync_entry
 
     def __str__(self):
-        return 'Invalid sync entry {} {}'.format(self.__table_name, json.dumps(self.__sync_entry))
+        return 'Invalid sync entry {} {}'.format(self.__table_name, dumps(self.__sync_entry).decode('utf-8'))
 
 class InvalidSyncEntryType(Exception):
     def __init__(self, entry_type):
@@ -1,13 +1,16 @@
-import ujson as json
-
 from falcon import (
     HTTP_BAD_REQUEST, HTTP_CONFLICT, HTTP_METHOD_NOT_ALLOWED, HTTP_NOT_FOUND, HTTP_OK, Request, Response
 )
 
-from sqlalchemy import false, Sequence
+from marshmallow import ValidationError
+
+from sqlalchemy import Sequence
+from sqlalchemy.orm.exc import StaleDataError
 
-from gam.database import Fixed, scoped_session, SoftDelete
-from users.utils import get_user_roles_map
+from gam.cache import response_cache
+from gam.database import Fixed, get_by_id, replica_monitor, request_session, scoped_session, SoftDelete, Versioned
+from gam.media import read_media
+from users.utils import get_request_roles_map
 from . import exceptions as exc
 from .models import Change
 from .schemas import ChangeSchema, UpwardChangeSchema
@@ -18,7 +21,7 @@ class SyncResource:
         model_cls, _, permissions = get_sync_model(item['table_name'])
         ctx = {
             'model': model_cls,
-            'roles': get_user_roles_map(req.context.user.id, extended=True),
+            'roles': get_request_roles_map(req),
             'user': req.context.user
         }
         for perm in permissions:
@@ -33,20 +36,19 @@ class SyncResource:
         i = 0
         end = False
         items = []
-        with scoped_session() as session:
+        # never go past what every replica has replayed, so that the
+        # docs of the returned changes can be read from any of them
+        watermark = replica_monitor.get_sync_watermark()
+        with request_session(readonly=True) as session:
             while i < batch_size and not end:
-                obj = session.query(Change).filter(Change.id > since).first()
+                qf = [Change.id > since, ]
+                if watermark is not None:
+                    qf.append(Change.id <= watermark)
+                obj = session.query(Change).filter(*qf).first()
                 if obj is None:
                     end = True
                     break
-                item, errors = ChangeSchema().dump(obj)
-                
-                if errors is not None:
-                    errors_num = len(errors)
-                    if errors_num > 0:
-                        resp.status = HTTP_BAD_REQUEST
-                        resp.body = json.dumps({'errors': errors})
-                        return
+                item = ChangeSchema().dump(obj)
                 
                 if self.__can_read_change(req, item):
                     items.append(item)
@@ -55,39 +57,38 @@ class SyncResource:
                 i = i + 1
         
         resp.status = HTTP_OK
-        resp.body = json.dumps(items)
+        resp.media = items
     
     def on_post_change(self, req: Request, resp: Response):
         try:
-            input_data = json.loads(req.stream.read(req.content_length or 0))
+            input_data = read_media(req)
         except (ValueError, KeyError):
             resp.status = HTTP_BAD_REQUEST
             return
         
-        changes, errors = UpwardChangeSchema().load(input_data, many=True)
-        if errors is not None:
-            errors_num = len(errors)
-            if errors_num > 0:
-                resp.status = HTTP_BAD_REQUEST
-                resp.body = json.dumps({'errors': errors})
-                return
+        try:
+            changes = UpwardChangeSchema().load(input_data, many=True)
+        except ValidationError as e:
+            resp.status = HTTP_BAD_REQUEST
+            resp.media = {'errors': e.messages}
+            return
         
         results = []
+        has_conflicts = False
         for change in changes:
             try:
                 res, conflict = self.__process_upward_change(change)
-            except (exc.FixedModel, exc.InvalidSyncEntry, exc.InvalidSyncEntryType, exc.InvalidSyncModel, exc.ModelNotFound):
+            except (exc.FixedModel, exc.InvalidSyncEntry, exc.InvalidSyncEntryType, exc.InvalidSyncModel, exc.ModelNotFound) as e:
                 resp.status = HTTP_BAD_REQUEST
-                resp.body = json.dumps({'errors': errors})
+                resp.media = {'errors': str(e)}
                 return
+            response_cache.invalidate(change.table_name)
             
             results.append(res)
-            if conflict:
-                resp.status = HTTP_CONFLICT
-                resp.body = json.dumps(results)
+            has_conflicts = has_conflicts or conflict
         
-        resp.status = HTTP_OK
-        resp.body = json.dumps(results)
+        resp.status = HTTP_CONFLICT if has_conflicts else HTTP_OK
+        resp.media = results
 
 
     def on_get_doc(self, resp: Response, obj_id=None):
@@ -99,10 +100,10 @@ class SyncResource:
             cid = int(obj_id)
         except (TypeError, ValueError):
             resp.status = HTTP_BAD_REQUEST
-            resp.body = '{"message": "Invalid id"}'
+            resp.media = {'message': 'Invalid id'}
             return
         
-        with scoped_session() as session:
+        with request_session() as session:
             change = session.query(Change).filter(Change.id == cid).first()
             if change is None:
                 resp.status = HTTP_NOT_FOUND
@@ -115,11 +116,11 @@ class SyncResource:
                 return
             
         resp.status = HTTP_OK
-        resp.body = json.dumps(obj)
+        resp.media = obj
 
     def on_post_docs(self, req: Request, resp: Response):
         try:
-            input_data = json.loads(req.stream.read(req.content_length or 0))
+            input_data = read_media(req)
             changes_ids = [int(c) for c in input_data['changes']]
         except (ValueError, KeyError):
             resp.status = HTTP_BAD_REQUEST
@@ -130,22 +131,39 @@ class SyncResource:
             return
         
         results = []
-        with scoped_session() as session:
+        with request_session(readonly=True) as session:
             changes = session.query(Change).filter(Change.id.in_(changes_ids)).all()
-
-            for change in changes:
-                obj = self.__get_object_dump_by_change(session, change)
-                if obj is None:
-                    continue
-                
-                change_dump, _ = ChangeSchema().dump(change)
-                change_dump.update({'object': obj})
-                results.append(change_dump)
+            found_ids = [change.id for change in changes]
+            results = self.__get_changes_docs(session, changes)
+        
+        found_num = len(found_ids)
+        if replica_monitor.engines and found_num < len(set(changes_ids)):
+            # changes not replayed yet by the replica
+            with request_session() as session:
+                changes = session.query(Change).filter(
+                    Change.id.in_(changes_ids),
+                    Change.id.notin_(found_ids)
+                ).all()
+                results = results + self.__get_changes_docs(session, changes)
         
         resp.status = HTTP_OK
-        resp.body = json.dumps(results)
+        resp.media = results
+    
+    def __get_changes_docs(self, session, changes):
+        results = []
+        for change in changes:
+            obj = self.__get_object_dump_by_change(session, change)
+            if obj is None:
+                continue
+            
+            change_dump = ChangeSchema().dump(change)
+            change_dump.update({'object': obj})
+            results.append(change_dump)
+        return results
     
     def __process_upward_change(self, change):
+        # every change is applied in a transaction of its own, the ones
+        # preceding a failing change stay applied
         model_cls, schema_cls, _ = get_sync_model(change.table_name)
         if model_cls is None or schema_cls is None:
             raise exc.InvalidSyncModel(change.table_name)
@@ -180,7 +198,7 @@ class SyncResource:
             return {
                 'sequence': change.sequence,
                 'ok': True
-            }
+            }, False
     
     def __process_upward_update_change(self, change):
         with scoped_session() as session:
@@ -189,18 +207,48 @@ class SyncResource:
             if instance is None:
                 raise exc.ModelNotFound(change.table_name, change.object_id)
             
-            update, err = schema_cls().load(change.object, session=session, instance=instance)
-            if err is not None:
-                err_num = len(err)
-                if err_num > 0:
-                    raise exc.InvalidSyncEntry(change.table_name, change.object)
-            
-            session.add(update)
+            data = dict(change.object or {})
+            expected_version = self.__pop_version(change, schema_cls, data)
+            if expected_version is not None and instance.version != expected_version:
+                return self.__version_conflict(change, instance.version), True
+
+            try:
+                update = schema_cls().load(data, session=session, instance=instance)
+                session.add(update)
+                # the UPDATE is conditional on the loaded version
+                session.flush()
+            except ValidationError:
+                raise exc.InvalidSyncEntry(change.table_name, change.object)
+            except StaleDataError:
+                session.rollback()
+                return self.__version_conflict(change, None), True
 
             return {
                 'sequence': change.sequence,
                 'ok': True
+            }, False
+
+    def __pop_version(self, change, schema_cls, data):
+        """Takes the (dump only) version out of the object, as an int."""
+        if not issubclass(schema_cls.Meta.model, Versioned):
+            return None
+        version = data.pop('version', None)
+        if version is None:
+            return None
+        try:
+            return int(version)
+        except (TypeError, ValueError):
+            raise exc.InvalidSyncEntry(change.table_name, change.object)
+
+    def __version_conflict(self, change, version):
+        return {
+            'sequence': change.sequence,
+            'ok': False,
+            'error': 'conflict',
+            'extra': {
+                'version': version
             }
+        }
     
     def __process_upward_insert_change(self, change):
         with scoped_session() as session:
@@ -211,22 +259,23 @@ class SyncResource:
                     'ok': False,
                     'error': 'conflict',
                     'extra': {
-                        'next_id': self.__reserve_id(change.table_name)
+                        'next_id': self.__reserve_id(change)
                     }
-                }
+                }, True
             
-            instance, err = schema_cls().load(change.object)
-            if err is not None:
-                err_num = len(err)
-                if err_num > 0:
-                    raise exc.InvalidSyncEntry(change.table_name, change.object)
+            data = dict(change.object or {})
+            self.__pop_version(change, schema_cls, data)
+            try:
+                instance = schema_cls().load(data, session=session)
+            except ValidationError:
+                raise exc.InvalidSyncEntry(change.table_name, change.object)
             
             session.add(instance)
             
             return {
                 'sequence': change.sequence,
                 'ok': True
-            }
+            }, False
     
     def __reserve_id(self, change):
         sequence_name = '{}_id_seq'.format(change.table_name)
@@ -238,16 +287,13 @@ class SyncResource:
         if model_cls is None or schema_cls is None:
             return None
         
-        qf = [model_cls.id == change.object_id, ]
-        if issubclass(model_cls, SoftDelete):
-            qf.append(model_cls.deleted == false())
-        return session.query(model_cls).filter(*qf).first(), schema_cls
+        return get_by_id(session, model_cls, change.object_id), schema_cls
 
     def __get_object_dump_by_change(self, session, change):
         obj, schema_cls = self.__get_object_by_change(session, change)
 
         if obj is None:
             return None
-        obj_dump, _ = schema_cls().dump(obj)
+        obj_dump = schema_cls().dump(obj)
 
         return obj_dump
@@ -1,4 +1,6 @@
-from marshmallow import fields, Schema
+from collections import namedtuple
+
+from marshmallow import fields, post_load, Schema
 from marshmallow_sqlalchemy import ModelSchema
 
 from .models import Change
@@ -11,9 +13,15 @@ class ChangeSchema(ModelSchema):
             'id', 'table_name', 'object_id', 'entry_type'
         )
 
+UpwardChange = namedtuple('UpwardChange', ('sequence', 'table_name', 'object_id', 'entry_type', 'object', ))
+
 class UpwardChangeSchema(Schema):
     sequence = fields.Int()
     table_name = fields.String()
     object_id = fields.Int()
     entry_type = fields.String()
     object = fields.Dict()
+
+    @post_load
+    def make_change(self, data, **_kwargs):
+        return UpwardChange(**{field: data.get(field) for field in UpwardChange._fields})
@@ -0,0 +1,111 @@
+import json
+
+import falcon
+import pytest
+
+from falcon import testing
+
+from agile.models import Epic
+from gam.app import create_app
+from gam.database import scoped_session
+from gam.media import packb, unpackb
+from projects.models import Project
+from users.hasher import make_password
+from users.models import User
+
+
+@pytest.fixture
+def client():
+    return testing.TestClient(create_app())
+
+@pytest.fixture
+def headers(client):
+    with scoped_session() as session:
+        user = User(username='sync_change_user', password=make_password('12345'))
+        session.add(user)
+    response = client.simulate_post('/auth/login', body=json.dumps({
+        'username': 'sync_change_user',
+        'password': '12345'
+    }))
+    yield {'Authorization': 'jwt ' + response.json['token']}
+    with scoped_session() as session:
+        session.query(User).filter(User.username == 'sync_change_user').delete()
+
+@pytest.fixture
+def epic():
+    with scoped_session() as session:
+        project = Project(name='sync', slug='sync')
+        session.add(project)
+        session.flush()
+        epic = Epic(project_id=project.id, name='epic')
+        session.add(epic)
+        session.flush()
+        ids = (project.id, epic.id, )
+    with scoped_session() as session:
+        yield session.query(Epic).get(ids[1])
+    with scoped_session() as session:
+        session.query(Epic).filter(Epic.project_id == ids[0]).delete()
+        session.query(Project).filter(Project.id == ids[0]).delete()
+
+def __update(epic, version):
+    return [{
+        'sequence': 1,
+        'table_name': Epic.__tablename__,
+        'object_id': epic.id,
+        'entry_type': 'update',
+        'object': {'name': 'renamed', 'version': version},
+    }]
+
+def __get_name(epic_id):
+    with scoped_session() as session:
+        return session.query(Epic).get(epic_id).name
+
+
+# -------- Upward changes -------------
+# updates made to the current version are applied
+@pytest.mark.parametrize('as_str', [False, True])
+def test_update_version_match(client, headers, epic, as_str):
+    version = str(epic.version) if as_str else epic.version
+    response = client.simulate_post('/sync/change', headers=headers, body=json.dumps(__update(epic, version)))
+    assert response.status == falcon.HTTP_200
+    assert response.json == [{'sequence': 1, 'ok': True}]
+    assert __get_name(epic.id) == 'renamed'
+
+# updates made to an older version are reported as conflicts, with the current version
+def test_update_version_conflict(client, headers, epic):
+    response = client.simulate_post('/sync/change', headers=headers, body=json.dumps(__update(epic, epic.version - 1)))
+    assert response.status == falcon.HTTP_409
+    assert response.json[0]['error'] == 'conflict'
+    assert response.json[0]['extra'] == {'version': epic.version}
+    assert __get_name(epic.id) == 'epic'
+
+def test_update_invalid_version(client, headers, epic):
+    response = client.simulate_post('/sync/change', headers=headers, body=json.dumps(__update(epic, 'x')))
+    assert response.status == falcon.HTTP_400
+    assert __get_name(epic.id) == 'epic'
+
+# the version echoed back on inserts is ignored
+def test_insert_with_version(client, headers, epic):
+    with scoped_session() as session:
+        next_id = session.execute("SELECT nextval('agile_epic_id_seq')").scalar()
+    response = client.simulate_post('/sync/change', headers=headers, body=json.dumps([{
+        'sequence': 1,
+        'table_name': Epic.__tablename__,
+        'object_id': next_id,
+        'entry_type': 'insert',
+        'object': {'id': next_id, 'project_id': epic.project_id, 'name': 'inserted', 'version': 5},
+    }]))
+    assert response.status == falcon.HTTP_200
+    assert __get_name(next_id) == 'inserted'
+
+# upward changes can be sent, and answered, as MessagePack
+def test_update_msgpack(client, headers, epic):
+    response = client.simulate_post('/sync/change', headers={
+        **headers,
+        'Content-Type': falcon.MEDIA_MSGPACK,
+        'Accept': falcon.MEDIA_MSGPACK,
+    }, body=packb(__update(epic, epic.version)))
+    assert response.status == falcon.HTTP_200
+    assert response.headers['content-type'] == falcon.MEDIA_MSGPACK
+    assert unpackb(response.content) == [{'sequence': 1, 'ok': True}]
+    assert __get_name(epic.id) == 'renamed'
@@ -113,9 +113,75 @@ def __create_after_delete_trigger(session: Session, model_cls: Base):
     """.format(trigger_name=trigger_name, table_name=table_name)
     session.execute(sql)
 
+def __create_related_change_entry_creation_function(session: Session):
+    change_table_name = Change.__tablename__
+    sql = """
+    DO $dobody$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_proc WHERE proname = 'sync_create_related_change_entry') THEN
+            CREATE FUNCTION sync_create_related_change_entry() RETURNS TRIGGER AS $funcbody$
+            DECLARE
+                p_table_name VARCHAR;
+                p_foreign_key VARCHAR;
+                p_object_id INT;
+            BEGIN
+                IF array_length(TG_ARGV, 1) <> 2 THEN
+                    RAISE EXCEPTION 'Invalid arguments';
+                END IF;
+                p_table_name := TG_ARGV[0];
+                p_foreign_key := TG_ARGV[1];
+                IF TG_OP = 'DELETE' THEN
+                    p_object_id := (to_jsonb(OLD)->>p_foreign_key)::INT;
+                ELSE
+                    p_object_id := (to_jsonb(NEW)->>p_foreign_key)::INT;
+                END IF;
+                IF p_object_id IS NOT NULL THEN
+                    INSERT INTO {change_table_name} (table_name, object_id, entry_type) VALUES (p_table_name, p_object_id, 'update');
+                END IF;
+                RETURN NULL;
+            END;
+            $funcbody$ LANGUAGE PLPGSQL;
+        END IF;
+    END
+    $dobody$;
+    """.format(change_table_name=change_table_name)
+    session.execute(sql)
+
+def __create_after_related_change_trigger(session: Session, model_cls: Base, related_cls: Base, foreign_key: str):
+    table_name = model_cls.__tablename__
+    related_table_name = related_cls.__tablename__
+    trigger_name = 'sync_change_after_change_{related_table_name}_trigger'.format(related_table_name=related_table_name)
+
+    sql = """
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = '{related_table_name}')
+        AND NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = '{trigger_name}') THEN
+            CREATE TRIGGER {trigger_name}
+            AFTER INSERT OR UPDATE OR DELETE ON {related_table_name}
+            FOR EACH ROW EXECUTE PROCEDURE sync_create_related_change_entry('{table_name}', '{foreign_key}');
+        END IF;
+    END
+    $$;
+    """.format(
+        trigger_name=trigger_name,
+        table_name=table_name,
+        related_table_name=related_table_name,
+        foreign_key=foreign_key
+    )
+    session.execute(sql)
+
 def check_triggers(model_cls):
     with scoped_session() as session:
         __create_change_entry_creation_function(session)
         __create_after_insert_trigger(session, model_cls)
         __create_after_update_trigger(session, model_cls, issubclass(model_cls, SoftDelete))
         __create_after_delete_trigger(session, model_cls)
+
+def check_related_triggers(model_cls, related_cls, foreign_key):
+    """Records changes of related_cls rows as updates of the model_cls
+    row they point to through foreign_key.
+    """
+    with scoped_session() as session:
+        __create_related_change_entry_creation_function(session)
+        __create_after_related_change_trigger(session, model_cls, related_cls, foreign_key)
@@ -0,0 +1,71 @@
+import threading
+import time
+
+from sqlalchemy import func
+
+from gam.database import scoped_session
+from gam.settings import SYNC_CHANGES_POLL_INTERVAL
+from .models import Change
+
+
+class ChangeWatcher:
+    """Polls sync_change for changes made by any process and notifies them
+    to the subscribed listeners as listener(table_name, object_id).
+    Listeners get (None, None) when there are too many changes to list.
+    Polling happens on demand, at most once every `poll_interval` seconds.
+    """
+    max_changes = 10000
+    # changes are numbered on insert but become visible on commit,
+    # so recent ids are polled again in case an older transaction commits late
+    overlap = 100
+
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+        self.__listeners = []
+        self.__lock = threading.Lock()
+        self.__last_id = None
+        self.__seen = set()
+        self.__polled_at = None
+
+    def subscribe(self, listener):
+        self.__listeners.append(listener)
+
+    def __notify(self, table_name, object_id):
+        for listener in self.__listeners:
+            listener(table_name, object_id)
+
+    def poll(self):
+        now = time.monotonic()
+        if self.__polled_at is not None and now - self.__polled_at < self.poll_interval:
+            return
+        if not self.__lock.acquire(blocking=False):
+            return
+        try:
+            self.__polled_at = now
+            with scoped_session() as session:
+                if self.__last_id is None:
+                    self.__last_id = session.query(func.coalesce(func.max(Change.id), 0)).scalar()
+                    return
+                changes = session.query(
+                    Change.id, Change.table_name, Change.object_id
+                ).filter(
+                    Change.id > self.__last_id - self.overlap
+                ).order_by(Change.id).limit(self.max_changes).all()
+            changes_num = len(changes)
+            if changes_num >= self.max_changes:
+                self.__last_id = changes[-1][0]
+                self.__seen = set()
+                self.__notify(None, None)
+                return
+            for change_id, table_name, object_id in changes:
+                if change_id in self.__seen:
+                    continue
+                self.__seen.add(change_id)
+                self.__notify(table_name, object_id)
+            if changes_num > 0:
+                self.__last_id = max(self.__last_id, changes[-1][0])
+            self.__seen = {i for i in self.__seen if i > self.__last_id - self.overlap}
+        finally:
+            self.__lock.release()
+
+change_watcher = ChangeWatcher(SYNC_CHANGES_POLL_INTERVAL)
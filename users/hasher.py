@@ -1,10 +1,17 @@
 import base64
+import fcntl
 import hashlib
 import hmac
+import os
 import random
 import time
 
-from gam.settings import SECRET_KEY
+from importlib import import_module
+
+from gam.settings import (
+    HASHER_LOCK_DIR, HASHER_MAX_PENDING, HASHER_POOL_SIZE, PASSWORD_HASHERS,
+    PASSWORD_PBKDF2_ITERATIONS, PASSWORD_SCRYPT_WORK_FACTOR, SECRET_KEY,
+)
 from gam.utils import force_bytes
 
 try:
@@ -15,9 +22,52 @@ except NotImplementedError:
     warnings.warn('A secure pseudo-random number generator is not available '
                   'on your system. Falling back to Mersenne Twister.')
 
-_DEFAULT_ALGORITHM = 'pbkdf2_sha256'
-_DEFAULT_ITERATIONS = 120000
-_DEFAULT_DIGEST = hashlib.sha256
+class HasherBusy(Exception):
+    """Raised when too many passwords are already waiting to be hashed."""
+
+class HashingPool:
+    """Bounds password hashing across every process of the host, whatever
+    the server runs them on: at most `workers` hashings run at once and at
+    most `max_pending` run or wait, the others are rejected with HasherBusy.
+    Slots are files of `lock_dir` locked with flock(), which the kernel
+    releases when a worker dies.
+    """
+    poll_interval = 0.005
+
+    def __init__(self, workers, max_pending, lock_dir):
+        os.makedirs(lock_dir, exist_ok=True)
+        self.__running = [os.path.join(lock_dir, 'running-{}'.format(i)) for i in range(workers)]
+        self.__pending = [os.path.join(lock_dir, 'pending-{}'.format(i)) for i in range(max_pending)]
+
+    def __lock_slot(self, paths):
+        """Returns the descriptor of the slot locked, None when all are taken."""
+        for path in paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    def run(self, fn, *args):
+        pending = self.__lock_slot(self.__pending)
+        if pending is None:
+            raise HasherBusy()
+        try:
+            running = self.__lock_slot(self.__running)
+            while running is None:
+                time.sleep(self.poll_interval)
+                running = self.__lock_slot(self.__running)
+            try:
+                return fn(*args)
+            finally:
+                # closing the descriptor releases the lock
+                os.close(running)
+        finally:
+            os.close(pending)
+
+hashing_pool = HashingPool(HASHER_POOL_SIZE, HASHER_MAX_PENDING, HASHER_LOCK_DIR)
 
 def pbkdf2(password, salt, iterations, dklen=0, digest=None):
     """Return the hash of password using pbkdf2."""
@@ -28,27 +78,121 @@ def pbkdf2(password, salt, iterations, dklen=0, digest=None):
     salt = force_bytes(salt)
     return hashlib.pbkdf2_hmac(digest().name, password, salt, iterations, dklen)
 
-def encode_password(password, salt=None, iterations=None):
-    assert password is not None
-    assert salt and '$' not in salt
-    iterations = iterations or _DEFAULT_ITERATIONS
-    hash_str = pbkdf2(password, salt, iterations, digest=_DEFAULT_DIGEST)
-    hash_str = base64.b64encode(hash_str).decode('ascii').strip()
-    return "%s$%d$%s$%s" % (_DEFAULT_ALGORITHM, iterations, salt, hash_str)
-
-def make_password(password):
-    salt = get_random_string()
-    return encode_password(password, salt)
-
 def constant_time_compare(val1, val2):
     """Return True if the two strings are equal, False otherwise."""
     return hmac.compare_digest(force_bytes(val1), force_bytes(val2))
 
+class BasePasswordHasher:
+    """Encoded passwords are "<algorithm>$<parameters...>$<salt>$<hash>"."""
+    algorithm = None
+
+    def salt(self):
+        return get_random_string()
+
+    def encode(self, password, salt):
+        raise NotImplementedError
+
+    def verify(self, password, encoded):
+        raise NotImplementedError
+
+    def must_update(self, _encoded):
+        """Tells whether the encoded password uses outdated parameters."""
+        return False
+
+class PBKDF2PasswordHasher(BasePasswordHasher):
+    algorithm = 'pbkdf2_sha256'
+    iterations = PASSWORD_PBKDF2_ITERATIONS
+    digest = hashlib.sha256
+
+    def encode(self, password, salt, iterations=None):
+        assert password is not None
+        assert salt and '$' not in salt
+        iterations = iterations or self.iterations
+        hash_str = pbkdf2(password, salt, iterations, digest=self.digest)
+        hash_str = base64.b64encode(hash_str).decode('ascii').strip()
+        return "%s$%d$%s$%s" % (self.algorithm, iterations, salt, hash_str)
+
+    def verify(self, password, encoded):
+        algorithm, iterations, salt, _ = encoded.split('$', 3)
+        assert algorithm == self.algorithm
+        encoded_2 = self.encode(password, salt, int(iterations))
+        return constant_time_compare(encoded, encoded_2)
+
+    def must_update(self, encoded):
+        _, iterations, _, _ = encoded.split('$', 3)
+        return int(iterations) != self.iterations
+
+class ScryptPasswordHasher(BasePasswordHasher):
+    algorithm = 'scrypt'
+    work_factor = PASSWORD_SCRYPT_WORK_FACTOR
+    block_size = 8
+    parallelism = 1
+    dklen = 64
+
+    def encode(self, password, salt, work_factor=None, block_size=None, parallelism=None):
+        assert password is not None
+        assert salt and '$' not in salt
+        work_factor = work_factor or self.work_factor
+        block_size = block_size or self.block_size
+        parallelism = parallelism or self.parallelism
+        hash_str = hashlib.scrypt(
+            force_bytes(password),
+            salt=force_bytes(salt),
+            n=work_factor,
+            r=block_size,
+            p=parallelism,
+            maxmem=128 * work_factor * block_size * 2,
+            dklen=self.dklen,
+        )
+        hash_str = base64.b64encode(hash_str).decode('ascii').strip()
+        return "%s$%d$%d$%d$%s$%s" % (self.algorithm, work_factor, block_size, parallelism, salt, hash_str)
+
+    def verify(self, password, encoded):
+        algorithm, work_factor, block_size, parallelism, salt, _ = encoded.split('$', 5)
+        assert algorithm == self.algorithm
+        encoded_2 = self.encode(password, salt, int(work_factor), int(block_size), int(parallelism))
+        return constant_time_compare(encoded, encoded_2)
+
+    def must_update(self, encoded):
+        _, work_factor, block_size, parallelism, _, _ = encoded.split('$', 5)
+        return (int(work_factor), int(block_size), int(parallelism), ) != \
+            (self.work_factor, self.block_size, self.parallelism, )
+
+__hashers = []
+
+def get_hashers():
+    """Instances of the PASSWORD_HASHERS, the first one hashes new passwords."""
+    if not __hashers:
+        for path in PASSWORD_HASHERS:
+            module_name, class_name = path.rsplit('.', 1)
+            __hashers.append(getattr(import_module(module_name), class_name)())
+    return __hashers
+
+def get_hasher(algorithm=None):
+    hashers = get_hashers()
+    if algorithm is None:
+        return hashers[0]
+    for hasher in hashers:
+        if hasher.algorithm == algorithm:
+            return hasher
+    raise ValueError('Unknown password hashing algorithm {}'.format(algorithm))
+
+def encode_password(password, salt=None, iterations=None):
+    return PBKDF2PasswordHasher().encode(password, salt, iterations)
+
+def make_password(password):
+    hasher = get_hasher()
+    return hashing_pool.run(hasher.encode, password, hasher.salt())
+
 def verify_password(password, encoded):
-    algorithm, iterations, salt, _ = encoded.split('$', 3)
-    assert algorithm == _DEFAULT_ALGORITHM
-    encoded_2 = encode_password(password, salt, int(iterations))
-    return constant_time_compare(encoded, encoded_2)
+    hasher = get_hasher(encoded.split('$', 1)[0])
+    return hashing_pool.run(hasher.verify, password, encoded)
+
+def must_update_password(encoded):
+    """Tells whether the password should be hashed again with the preferred hasher and parameters."""
+    algorithm = encoded.split('$', 1)[0]
+    hasher = get_hasher()
+    return algorithm != hasher.algorithm or hasher.must_update(encoded)
 
 def get_random_string(length=12,
                       allowed_chars='abcdefghijklmnopqrstuvwxyz'
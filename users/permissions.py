@@ -1,13 +1,18 @@
 from sqlalchemy import and_, cast, or_
 from sqlalchemy.dialects.postgresql import JSONB
 
-from gam.database import scoped_session
+from gam.database import request_session
 from .models import User, UserRole
 from .roles import (
     ROLE_ADMIN, ROLE_SUPER_ADMIN
 )
 
-class SuperAdminWriteFilter:
+class BaseFilter:
+    # whether reads depend on the user itself rather than only on their roles,
+    # responses are then cached per user
+    user_scoped = False
+
+class SuperAdminWriteFilter(BaseFilter):
     @classmethod
     def apply_filter(cls, ctx, queryset):
         method = ctx['method']
@@ -29,7 +34,7 @@ class SuperAdminWriteFilter:
     def can_read_change(cls, _ctx, _itm):
         return True
 
-class CountryAdminWriteFilter:
+class CountryAdminWriteFilter(BaseFilter):
     @classmethod
     def apply_filter(cls, ctx, queryset):
         method = ctx['method']
@@ -51,7 +56,9 @@ class CountryAdminWriteFilter:
     def can_read_change(cls, _ctx, _itm):
         return True
 
-class SelfFilter:
+class SelfFilter(BaseFilter):
+    user_scoped = True
+
     @classmethod
     def apply_filter(cls, ctx, queryset):
         model_cls = ctx['model']
@@ -70,7 +77,7 @@ class SelfFilter:
         user = ctx['user']
         return 'user_id' in itm and itm['user_id'] == user.id
 
-class UsersFilter:
+class UsersFilter(BaseFilter):
     @classmethod
     def apply_filter(cls, ctx, queryset):
         method = ctx['method']
@@ -131,7 +138,7 @@ class UsersFilter:
         if user_projects_num == 0:
             return False
         
-        with scoped_session() as session:
+        with request_session(readonly=True) as session:
             for c in session.query(Project.country_id).filter(Project.id.in_(user_projects)):
                 if c[0] not in countries:
                     return False
@@ -201,7 +208,7 @@ class UsersFilter:
         if itm['object_id'] == user.id:
             return True
         
-        with scoped_session() as session:
+        with request_session(readonly=True) as session:
             user_roles = session.query(UserRole).filter(UserRole.user_id == itm['object_id']).all()
         
             if ROLE_SUPER_ADMIN in roles and cls.__super_admin_can_read_change(user_roles):
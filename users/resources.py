@@ -1,21 +1,24 @@
 from datetime import datetime
 
-import ujson as json
-
-from falcon import HTTP_BAD_REQUEST, HTTP_OK, MEDIA_JSON, Request, Response
+from falcon import (
+    HTTP_BAD_REQUEST, HTTP_OK, HTTP_TOO_MANY_REQUESTS, HTTPTooManyRequests, Request, Response
+)
 
 from sqlalchemy import false
+from sqlalchemy.dialects.postgresql import insert
 
-from gam.database import scoped_session
+from gam.database import request_session
+from gam.media import read_media
 from gam.middleware import auth_backend, auth_expired_backend
+from gam.settings import HASHER_RETRY_AFTER
 from gam.resources import ModelResource
-from .hasher import make_password
+from .hasher import HasherBusy, make_password
 from .models import RefreshToken, Role, User, UserRole, UserSetting
 from .permissions import SuperAdminWriteFilter, UsersFilter
 from .schemas import (
-    OnlineUserSchema, RoleSchema, TokenPayloadSchema, UserCreateSchema, UserSchema, UserSettingSchema,
+    OnlineUserSchema, RoleSchema, UserCreateSchema, UserSchema, UserSettingSchema,
 )
-from .utils import authenticate_user
+from .utils import authenticate_user, get_token_payload, invalidate_user, invalidate_user_roles
 
 
 class LoginResource:
@@ -42,35 +45,38 @@ class LoginResource:
                 401:
                     description: Submitted invalid credentials
         """
-        resp.content_type = MEDIA_JSON
         try:
-            params = json.loads(req.stream.read(req.content_length or 0))
+            params = read_media(req)
             username = params['username']
             password = params['password']
         except (KeyError, TypeError, ValueError):
-            resp.body = '{"message": "Please provide username and password"}'
+            resp.media = {'message': 'Please provide username and password'}
             resp.status = HTTP_BAD_REQUEST
             return
-        user = authenticate_user(username, password)
+        try:
+            user = authenticate_user(username, password)
+        except HasherBusy:
+            resp.media = {'message': 'Too many logins, please retry later'}
+            resp.status = HTTP_TOO_MANY_REQUESTS
+            resp.append_header('Retry-After', str(HASHER_RETRY_AFTER))
+            return
         if user is None:
-            resp.body = '{"message": "Invalid credentials"}'
+            resp.media = {'message': 'Invalid credentials'}
             resp.status = HTTP_BAD_REQUEST
             return
-        payload = TokenPayloadSchema().dump(user)
+        payload = get_token_payload(user, {ur.role_id: ur.extra for ur in user.role_assoc})
         payload['token'] = auth_backend.get_auth_token(payload)
-        with scoped_session() as session:
-            rt = session.query(RefreshToken).filter(
-                RefreshToken.user_id == payload['user_id']
-            ).first()
-            if rt is None:
-                rt = RefreshToken(user_id=payload['user_id'])
-                session.add(rt)
-                session.commit()
-            refresh_token = rt.token
-            user_instance = session.query(User).filter(User.id == user.id).first()
-            payload['user'] = UserSchema().dump(user_instance)
+        with request_session() as session:
+            # keeps the existing token, RETURNING needs the row to be updated
+            refresh_token = session.execute(
+                insert(RefreshToken.__table__).values(user_id=user.id).on_conflict_do_update(
+                    index_elements=['user_id'],
+                    set_={'token': RefreshToken.__table__.c.token}
+                ).returning(RefreshToken.__table__.c.token)
+            ).scalar()
+        payload['user'] = UserSchema().dump(user)
         payload['refresh_token'] = refresh_token
-        resp.body = json.dumps(payload)
+        resp.media = payload
         resp.status = HTTP_OK
 
 class LogoutResource:
@@ -86,7 +92,7 @@ class LogoutResource:
                     description: Fails on unauthorized (tokenless) request
         """
         user = req.context['user']
-        with scoped_session() as session:
+        with request_session() as session:
             rt = session.query(RefreshToken).filter(
                 RefreshToken.user_id == user.id
             ).first()
@@ -120,25 +126,25 @@ class RefreshTokenResource:
         """
         user = req.context['user']
         try:
-            params = json.loads(req.stream.read(req.content_length or 0))
+            params = read_media(req)
             refresh_token = params['refresh_token']
         except (KeyError, TypeError, ValueError):
-            resp.body = '{"message": "Please provide a refresh token"}'
+            resp.media = {'message': 'Please provide a refresh token'}
             resp.status = HTTP_BAD_REQUEST
             return
-        with scoped_session() as session:
+        with request_session() as session:
             rt = session.query(RefreshToken).filter(
                 RefreshToken.user_id == user.id,
                 RefreshToken.token == refresh_token
             ).first()
             if rt is None:
-                resp.body = '{"message": "Invalid refresh token"}'
+                resp.media = {'message': 'Invalid refresh token'}
                 resp.status = HTTP_BAD_REQUEST
                 return
-        payload = TokenPayloadSchema().dump(user).data
+        payload = get_token_payload(user)
         payload['token'] = auth_backend.get_auth_token(payload)
         payload['refresh_token'] = refresh_token
-        resp.body = json.dumps(payload)
+        resp.media = payload
         resp.status = HTTP_OK
 
 class UsersResource(ModelResource):
@@ -152,66 +158,67 @@ class UsersResource(ModelResource):
     }
     permissions = (UsersFilter, )
 
-    def __init__(self):
-        super().__init__()
-        self.__roles = None
-
     def _process_create_data(self, data):
         if 'password' in data:
-            data['password'] = make_password(data['password'])
-        if 'roles' in data:
-            self.__roles = data['roles']
-            del data['roles']
+            data['password'] = self.__make_password(data['password'])
+        # roles sent with the item, None when they are left unchanged
+        return data.pop('roles', None)
 
     def _process_update_data(self, data, input_data):
         if 'password' in input_data and input_data['password'] is not None:
-            input_data['password'] = make_password(input_data['password'])
+            input_data['password'] = self.__make_password(input_data['password'])
         else:
             input_data['password'] = data.password
-        if 'roles' in input_data:
-            self.__roles = input_data['roles']
-            del input_data['roles']
+        return input_data.pop('roles', None)
     
-    def _post_create(self, session, instance):
-        self.__update_roles(session, instance)
+    def __make_password(self, password):
+        try:
+            return make_password(password)
+        except HasherBusy:
+            raise HTTPTooManyRequests(
+                description='Too many passwords being hashed, please retry later',
+                retry_after=HASHER_RETRY_AFTER
+            )
+
+    def _post_create(self, session, instance, extra=None):
+        self.__update_roles(session, instance, extra)
     
-    def _post_update(self, session, instance):
-        self.__update_roles(session, instance)
+    def _post_update(self, session, instance, extra=None):
+        invalidate_user(instance.id)
+        self.__update_roles(session, instance, extra)
     
-    def __update_roles(self, session, instance):
-        if self.__roles is None:
+    def __update_roles(self, session, instance, roles):
+        if roles is None:
             return
-        existing_user_roles = []
-        for role in self.__roles:
-            role_id = role['role_id'] or None if 'role_id' in role else None
-            extra = role['extra'] or {} if 'extra' in role else {}
-            user_role = session.query(UserRole).filter(
-                UserRole.user_id == instance.id,
-                UserRole.role_id == role['role_id']).first()
-            if user_role is None:
-                user_role = UserRole(
-                    user_id=instance.id,
-                    role_id=role_id,
-                    extra=extra)
-            else:
-                user_role.extra = extra
-            user_role.extra = extra
-            session.add(user_role)
-            session.commit()
-            existing_user_roles.append(user_role.role_id)
+        extras = {}
+        for role in roles:
+            if role.get('role_id') is not None:
+                extras[role['role_id']] = role.get('extra') or {}
+        roles_num = len(extras)
+        if roles_num > 0:
+            stmt = insert(UserRole.__table__).values([
+                {'user_id': instance.id, 'role_id': role_id, 'extra': extra}
+                for role_id, extra in extras.items()
+            ])
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=['user_id', 'role_id'],
+                set_={'extra': stmt.excluded.extra}
+            ))
         session.query(UserRole).filter(
             UserRole.user_id == instance.id,
-            UserRole.role_id.notin_(existing_user_roles)).delete(synchronize_session=False)
+            UserRole.role_id.notin_(list(extras))).delete(synchronize_session=False)
+        session.expire(instance, ['role_assoc'])
+        invalidate_user_roles(instance.id)
 
 class MeResource:
     def on_get(self, req: Request, resp: Response):
         user = req.context['user']
-        with scoped_session() as session:
+        with request_session() as session:
             instance = session.query(User).filter(
                 User.id == user.id
             ).first()
             payload = UserSchema().dump(instance)
-            resp.body = json.dumps(payload)
+            resp.media = payload
         resp.status = HTTP_OK
 
 class RolesResource(ModelResource):
@@ -16,7 +16,7 @@ class UserRoleSchema(ModelSchema):
             'user_id', 'role_id', 'extra',
         )
 
-@sync_model(permissions=(UsersFilter, ))
+@sync_model(permissions=(UsersFilter, ), related=((UserRole, 'user_id', ), ))
 class UserSchema(ModelSchema):
     email = Email()
     roles = Nested(UserRoleSchema, attribute='role_assoc', many=True, exclude=('user_id', ))
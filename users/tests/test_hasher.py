@@ -0,0 +1,140 @@
+import json
+import multiprocessing
+import os
+import threading
+
+import falcon
+import pytest
+
+from falcon import testing
+
+from gam.app import create_app
+from gam.database import scoped_session
+from gam.settings import HASHER_RETRY_AFTER
+from users import hasher
+from users.hasher import (
+    HasherBusy, HashingPool, PBKDF2PasswordHasher, ScryptPasswordHasher,
+    get_hasher, make_password, must_update_password, verify_password,
+)
+from users.models import User
+
+
+class FastPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    iterations = 1000
+
+class FastScryptPasswordHasher(ScryptPasswordHasher):
+    work_factor = 2 ** 4
+
+
+# -------- Hashers --------------------
+# every hasher verifies its own encodings, and nothing else
+@pytest.mark.parametrize('hasher', [FastPBKDF2PasswordHasher(), FastScryptPasswordHasher()])
+def test_hasher_verify(hasher):
+    encoded = hasher.encode('12345', hasher.salt())
+    assert encoded.startswith(hasher.algorithm + '$')
+    assert hasher.verify('12345', encoded)
+    assert not hasher.verify('54321', encoded)
+
+# encodings made with other parameters still verify, but must be updated
+def test_pbkdf2_must_update():
+    hasher = FastPBKDF2PasswordHasher()
+    encoded = PBKDF2PasswordHasher().encode('12345', 'salt', 500)
+    assert hasher.verify('12345', encoded)
+    assert hasher.must_update(encoded)
+    assert not hasher.must_update(hasher.encode('12345', 'salt'))
+
+def test_scrypt_must_update():
+    hasher = FastScryptPasswordHasher()
+    encoded = hasher.encode('12345', 'salt', work_factor=2 ** 3)
+    assert hasher.verify('12345', encoded)
+    assert hasher.must_update(encoded)
+    assert not hasher.must_update(hasher.encode('12345', 'salt'))
+
+
+# -------- Registry -------------------
+# new passwords are hashed by the preferred hasher
+def test_make_password():
+    encoded = make_password('12345')
+    assert encoded.startswith(get_hasher().algorithm + '$')
+    assert verify_password('12345', encoded)
+    assert not must_update_password(encoded)
+
+# passwords hashed by another registered hasher verify and must be updated
+def test_verify_other_algorithm():
+    encoded = FastScryptPasswordHasher().encode('12345', 'salt')
+    assert verify_password('12345', encoded)
+    assert must_update_password(encoded)
+
+def test_unknown_algorithm():
+    with pytest.raises(ValueError):
+        verify_password('12345', 'md5$salt$hash')
+
+
+# -------- Pool -----------------------
+# hashings past the pending limit are rejected
+def test_pool_busy(tmp_path):
+    pool = HashingPool(1, 1, str(tmp_path))
+
+    def nested():
+        return pool.run(lambda: True)
+
+    with pytest.raises(HasherBusy):
+        pool.run(nested)
+    assert pool.run(lambda: True)
+
+def __hold_slot(lock_dir, started, release):
+    HashingPool(1, 1, lock_dir).run(lambda: started.set() or release.wait(10))
+
+# the limit is shared by the processes of the host, as sync workers are
+def test_pool_busy_across_processes(tmp_path):
+    context = multiprocessing.get_context('fork')
+    started, release = context.Event(), context.Event()
+    worker = context.Process(target=__hold_slot, args=(str(tmp_path), started, release, ))
+    worker.start()
+    try:
+        assert started.wait(10)
+        with pytest.raises(HasherBusy):
+            HashingPool(1, 1, str(tmp_path)).run(lambda: True)
+    finally:
+        release.set()
+        worker.join(10)
+    assert HashingPool(1, 1, str(tmp_path)).run(lambda: True)
+
+# waiting hashings run once a running one is done
+def test_pool_waits_for_running(tmp_path):
+    pool = HashingPool(1, 2, str(tmp_path))
+    started, release = threading.Event(), threading.Event()
+    holder = threading.Thread(target=pool.run, args=(lambda: started.set() or release.wait(10), ))
+    holder.start()
+    assert started.wait(10)
+    threading.Timer(0.05, release.set).start()
+    assert pool.run(lambda: True)
+    holder.join(10)
+
+# logins get a 429 while the slots are taken
+def test_login_busy(tmp_path, monkeypatch):
+    monkeypatch.setattr(hasher, 'hashing_pool', HashingPool(1, 1, str(tmp_path)))
+    username = 'hasher_busy_{}'.format(os.getpid())
+    with scoped_session() as session:
+        session.add(User(username=username, password=FastPBKDF2PasswordHasher().encode('12345', 'salt')))
+    try:
+        started, release = threading.Event(), threading.Event()
+        holder = threading.Thread(
+            target=hasher.hashing_pool.run, args=(lambda: started.set() or release.wait(10), )
+        )
+        holder.start()
+        assert started.wait(10)
+        client = testing.TestClient(create_app())
+        try:
+            response = client.simulate_post('/auth/login', body=json.dumps({
+                'username': username,
+                'password': '12345'
+            }))
+        finally:
+            release.set()
+            holder.join(10)
+        assert response.status == falcon.HTTP_429
+        assert response.headers['retry-after'] == str(HASHER_RETRY_AFTER)
+    finally:
+        with scoped_session() as session:
+            session.query(User).filter(User.username == username).delete()
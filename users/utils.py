@@ -1,36 +1,129 @@
-from gam.database import scoped_session
-from .hasher import verify_password
+import time
+
+from sqlalchemy.orm import joinedload
+
+from gam.cache import TTLCache
+from gam.database import on_commit, request_session, scoped_session
+from gam.settings import (
+    JWT_EMBED_ROLES, JWT_ROLES_MAX_AGE, ROLES_CACHE_SIZE, ROLES_CACHE_TTL, USER_CACHE_SIZE, USER_CACHE_TTL,
+)
+from sync.watcher import change_watcher
+from .hasher import HasherBusy, make_password, must_update_password, verify_password
 from .models import User, UserRole
+from .schemas import TokenPayloadSchema
+
+__users_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+__roles_cache = TTLCache(ROLES_CACHE_SIZE, ROLES_CACHE_TTL)
+
+def __on_change(table_name, object_id):
+    # role changes are recorded in sync_change as updates of their user
+    if table_name is None:
+        __users_cache.clear()
+        __roles_cache.clear()
+    elif table_name == User.__tablename__:
+        __users_cache.delete(object_id)
+        __roles_cache.delete(object_id)
+
+change_watcher.subscribe(__on_change)
 
 def get_authenticated_user(payload):
     try:
         user_id = payload['user']['user_id']
-        with scoped_session() as session:
-            user = session.query(User).filter(
-                User.id == user_id
-            ).one_or_none()
-            session.expunge_all()
-        return user
     except KeyError:
         return None
+    change_watcher.poll()
+    user = __users_cache.get(user_id)
+    if user is None:
+        with request_session(readonly=True) as session:
+            user = session.query(User).filter(
+                User.id == user_id,
+                User.is_active.is_(True),
+                User.deleted.is_(False)
+            ).one_or_none()
+            if user is not None:
+                # cached users are shared between requests
+                session.expunge(user)
+        if user is not None:
+            __users_cache.set(user_id, user)
+    return user
 
 def authenticate_user(username, password):
+    """Loads the user along with their roles, verifying the password
+    once the connection is back in the pool.
+    """
+    # not the request session, which keeps its connection until the response
     with scoped_session() as session:
-        user = session.query(User).filter(
+        user = session.query(User).options(joinedload(User.role_assoc)).filter(
             User.username == username,
             User.is_active.is_(True),
             User.deleted.is_(False)
         ).one_or_none()
-        session.expunge_all()
-    if user is not None and not verify_password(password, user.password):
+        if user is not None:
+            for instance in [user, *user.role_assoc]:
+                session.expunge(instance)
+    if user is None or not verify_password(password, user.password):
         return None
+    if must_update_password(user.password):
+        __upgrade_password(user, password)
     return user
 
+def __upgrade_password(user, password):
+    try:
+        encoded = make_password(password)
+    except HasherBusy:
+        # the upgrade is retried on next login
+        return
+    with request_session() as session:
+        session.query(User).filter(User.id == user.id).update(
+            {'password': encoded}, synchronize_session=False
+        )
+    user.password = encoded
+
 def get_user_roles_map(uid, extended=False):
-    roles = {}
-    with scoped_session() as session:
-        q = session.query(UserRole).filter(UserRole.user_id == uid)
-        for role in q:
-            extra = {**role.extra}
-            roles[role.role_id] = extra
+    change_watcher.poll()
+    cached = __roles_cache.get(uid)
+    if cached is None:
+        cached = {}
+        with request_session(readonly=True) as session:
+            q = session.query(UserRole.role_id, UserRole.extra).filter(UserRole.user_id == uid)
+            for role_id, extra in q:
+                cached[role_id] = extra
+        __roles_cache.set(uid, cached)
+    return {role_id: {**extra} for role_id, extra in cached.items()}
+
+def get_token_payload(user, roles=None):
+    payload = TokenPayloadSchema().dump(user)
+    if JWT_EMBED_ROLES:
+        payload['roles'] = roles if roles is not None else get_user_roles_map(user.id)
+        payload['roles_iat'] = int(time.time())
+    return payload
+
+def __get_token_roles_map(req):
+    payload = getattr(req.context, 'token_payload', None)
+    if payload is None or 'user' not in payload:
+        return None
+    claims = payload['user']
+    if 'roles' not in claims or 'roles_iat' not in claims:
+        return None
+    if time.time() - claims['roles_iat'] > JWT_ROLES_MAX_AGE:
+        return None
+    # JSON object keys are strings
+    return {int(role_id): extra for role_id, extra in claims['roles'].items()}
+
+def get_request_roles_map(req):
+    """Roles map of the authenticated user, loaded once per request.
+    Fresh enough role claims of the token are used when present.
+    """
+    roles = getattr(req.context, 'user_roles', None)
+    if roles is None:
+        roles = __get_token_roles_map(req)
+    if roles is None:
+        roles = get_user_roles_map(req.context.user.id)
+    req.context.user_roles = roles
     return roles
+
+def invalidate_user(uid):
+    on_commit(__users_cache.delete, uid)
+
+def invalidate_user_roles(uid):
+    on_commit(__roles_cache.delete, uid)